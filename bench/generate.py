@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+'''Generate a synthetic media tree (camera cards and a phone) and an ingest.toml for it, for the benchmarks.
+
+The layout follows real devices: Sony style cards with DCIM/1xxMSDCF/DSCxxxxx.JPG photos with exif and
+PRIVATE/M4ROOT/CLIP/Cxxxx.MP4 clips with an mvhd atom, and a phone with DCIM/Camera/YYYYMMDD_HHMMSS(_n).jpg|mp4.
+Everything (names, dates, contents, mtimes) comes from the seed, so the same arguments give the same tree.
+'''
+
+import argparse
+import datetime
+import os
+from pathlib import Path
+import random
+import shutil
+import struct
+import sys
+import time
+
+import piexif
+
+# Files per DCF folder (100MSDCF, 101MSDCF, ...), and clips per card
+DCF_FOLDER_FILES = 9999
+CARD_CLIPS = 9999
+
+# Share of the files of each kind
+PHOTO_SHARE = 0.4
+CLIP_SHARE = 0.2
+
+# Seconds between 1904-01-01 (the mp4 epoch) and 1970-01-01
+MP4_EPOCH_OFFSET = 2082844800
+
+START = datetime.datetime(2023, 1, 1, 8, 0, 0)
+
+CONFIG = '''[var]
+cards = "{root}/cards"
+phone = "{root}/phone"
+media = "{output}"
+dest_folder = \'\'\'
+{{{{ var['media'] }}}} /
+{{{{ date.strftime('%Y') }}}} /
+{{{{ date.strftime('%m_%B').lower() }}}}
+\'\'\'
+dest_datetime = \'\'\'{{{{ date.strftime('%Y-%m-%d') }}}}_{{{{ date.strftime('%H-%M-%S') }}}}\'\'\'
+
+[[ingest]]
+name = "card clips"
+source = \'\'\'{{{{ var['cards'] }}}}/card(\\d+)/PRIVATE/M4ROOT/CLIP/C(\\d+)\\.MP4\'\'\'
+destination = \'\'\'
+{{% date = mp4['creation_time'] %}}
+{{{{ var['dest_folder'] }}}} /
+{{{{ var['dest_datetime'] }}}}_{{{{ m[1] }}}}_{{{{ m[2] }}}}{{{{ ext }}}}
+\'\'\'
+
+[[ingest]]
+name = "card photos"
+source = \'\'\'{{{{ var['cards'] }}}}/card(\\d+)/DCIM/(\\d{{3}})MSDCF/DSC(\\d+)\\.JPG\'\'\'
+destination = \'\'\'
+{{% date = exif['DateTime'] %}}
+{{{{ var['dest_folder'] }}}} /
+{{{{ var['dest_datetime'] }}}}_{{{{ m[1] }}}}_{{{{ m[2] }}}}_{{{{ m[3] }}}}{{{{ ext }}}}
+\'\'\'
+
+[[ingest]]
+name = "phone"
+source = \'\'\'{{{{ var['phone'] }}}}/DCIM/Camera/(\\d{{8}})_(\\d{{6}})(?:_(\\d+))?\\.(jpg|mp4)\'\'\'
+destination = \'\'\'
+{{% date = datetime.strptime(f'{{m[1]}}{{m[2]}}', '%Y%m%d%H%M%S') %}}
+{{{{ var['dest_folder'] }}}} /
+{{{{ var['dest_datetime'] }}}}{{{{ f'_{{m[3]}}' if m[3] else '' }}}}{{{{ ext }}}}
+\'\'\'
+'''
+
+
+def box(box_type: bytes, data: bytes) -> bytes:
+    return struct.pack('>I4s', 8 + len(data), box_type) + data
+
+
+def mp4(date: datetime.datetime, payload: bytes, brand: bytes) -> bytes:
+    '''A minimal MP4: ftyp, mdat with the payload, and a moov with an mvhd'''
+    created = int(date.replace(tzinfo=datetime.timezone.utc).timestamp()) + MP4_EPOCH_OFFSET
+    mvhd = box(b'mvhd', b'\0\0\0\0' + struct.pack('>IIII', created, created, 1000, 10000) + b'\0' * 80)
+    return box(b'ftyp', brand + b'\0\0\0\0' + brand) + box(b'mdat', payload) + box(b'moov', mvhd)
+
+
+def jpeg(date: datetime.datetime, payload: bytes, offset: str) -> bytes:
+    '''A JPEG with an exif APP1 segment, followed by the payload as scan data'''
+    exif = piexif.dump({
+        '0th': {piexif.ImageIFD.Make: b'SONY', piexif.ImageIFD.DateTime: date.strftime('%Y:%m:%d %H:%M:%S').encode()},
+        'Exif': {piexif.ExifIFD.DateTimeOriginal: date.strftime('%Y:%m:%d %H:%M:%S').encode(), piexif.ExifIFD.OffsetTime: offset.encode()},
+    })
+    return b'\xff\xd8\xff\xe1' + struct.pack('>H', len(exif) + 2) + exif + b'\xff\xda\x00\x02' + payload + b'\xff\xd9'
+
+
+class Generator:
+    def __init__(self, root: Path, seed: int, photo_size: int, clip_size: int):
+        self.root = root
+        self.random = random.Random(seed)
+        self.photo_size = photo_size
+        self.clip_size = clip_size
+        self.date = START
+        self.files = 0
+        self.bytes = 0
+
+    def _payload(self, size: int) -> bytes:
+        # Sizes vary around the configured one, so files aren't all the same size
+        return self.random.randbytes(self.random.randint(size // 2, size * 3 // 2))
+
+    def _next_date(self) -> datetime.datetime:
+        self.date += datetime.timedelta(seconds=self.random.randint(1, 600))
+        return self.date
+
+    def _write(self, path: Path, data: bytes, date: datetime.datetime):
+        path.write_bytes(data)
+        mtime = int(date.timestamp())
+        os.utime(path, (mtime, mtime))
+        self.files += 1
+        self.bytes += len(data)
+
+    def card(self, index: int, photos: int, clips: int):
+        card = self.root / 'cards' / f'card{index}'
+        for i in range(photos):
+            folder = card / 'DCIM' / f'{100 + i // DCF_FOLDER_FILES}MSDCF'
+            if i % DCF_FOLDER_FILES == 0:
+                folder.mkdir(parents=True, exist_ok=True)
+            date = self._next_date()
+            self._write(folder / f'DSC{i % DCF_FOLDER_FILES + 1:05d}.JPG', jpeg(date, self._payload(self.photo_size), '+01:00'), date)
+
+        clip_folder = card / 'PRIVATE' / 'M4ROOT' / 'CLIP'
+        clip_folder.mkdir(parents=True, exist_ok=True)
+        for i in range(clips):
+            date = self._next_date()
+            self._write(clip_folder / f'C{i + 1:04d}.MP4', mp4(date, self._payload(self.clip_size), b'XAVC'), date)
+
+    def phone(self, count: int):
+        camera = self.root / 'phone' / 'DCIM' / 'Camera'
+        camera.mkdir(parents=True, exist_ok=True)
+        last = None
+        burst = 0
+        for _ in range(count):
+            # Every so often a burst of shots in the same second gets _1, _2, ... suffixes
+            if last is not None and self.random.random() < 0.05:
+                burst += 1
+                date = last
+            else:
+                burst = 0
+                date = last = self._next_date()
+            suffix = f'_{burst}' if burst else ''
+            name = f'{date.strftime("%Y%m%d_%H%M%S")}{suffix}'
+            if self.random.random() < 0.25:
+                self._write(camera / f'{name}.mp4', mp4(date, self._payload(self.clip_size), b'mp42'), date)
+            else:
+                self._write(camera / f'{name}.jpg', jpeg(date, self._payload(self.photo_size), '+02:00'), date)
+
+
+def generate(root: Path, files: int, seed: int = 1, photo_size: int = 16 * 1024, clip_size: int = 64 * 1024, output: Path = None) -> Generator:
+    '''Generate a tree of about `files` files in root, and an ingest.toml that ingests it into output'''
+    if root.exists():
+        shutil.rmtree(root)
+    root.mkdir(parents=True)
+    generator = Generator(root, seed, photo_size, clip_size)
+
+    photos = int(files * PHOTO_SHARE)
+    clips = int(files * CLIP_SHARE)
+    cards = max(1, -(-clips // CARD_CLIPS))
+    for index in range(cards):
+        generator.card(index, photos // cards + (index < photos % cards), clips // cards + (index < clips % cards))
+    generator.phone(files - photos - clips)
+
+    (root / 'ingest.toml').write_text(CONFIG.format(root=root, output=output or root / 'out'))
+    return generator
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('root', type=Path, help='Where to generate the tree (replaced if it exists)')
+    parser.add_argument('--files', type=int, default=10000, help='Number of files (default: 10000)')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed (default: 1)')
+    parser.add_argument('--photo-size', type=int, default=16 * 1024, help='Average size in bytes of the photo data (default: 16 KiB)')
+    parser.add_argument('--clip-size', type=int, default=64 * 1024, help='Average size in bytes of the clip data (default: 64 KiB)')
+    parser.add_argument('--output', type=Path, help='Ingest destination written to the generated ingest.toml (default: ROOT/out)')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    generator = generate(args.root.resolve(), args.files, args.seed, args.photo_size, args.clip_size, args.output)
+    print(f'Generated {generator.files} files ({generator.bytes / 1024 / 1024:.1f} MiB) in {time.perf_counter() - start:.1f}s', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
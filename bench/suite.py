@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+'''Benchmarks for scanning, db dedup, metadata extraction, template rendering and end to end ingest.
+
+Runs against a tree made by bench/generate.py. Each benchmark is repeated and the results (with the
+median and best run) are saved as JSON, --compare prints how they changed against an earlier result.
+'''
+
+import argparse
+import datetime
+import json
+import logging
+import mmap
+import os
+from pathlib import Path
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import typing as t
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+# No progress bars in the middle of the results
+os.environ.setdefault('TQDM_DISABLE', '1')
+
+from tomlkit import parse
+
+import main as ingest
+from utils import exif, mp4
+from utils.db import find_existing
+from utils.path import PathMatch, longest_path_part, re_glob
+from utils.template import Template
+from utils.utils import UnionDict
+
+BENCHMARKS = ('scan', 'dedup', 'metadata', 'render', 'ingest')
+
+
+class Tree:
+    '''A generated tree: its config, and the files each ingest block finds'''
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.config = parse((root / 'ingest.toml').read_text())
+        self.context = {'var': {k: Template(v) for k, v in self.config['var'].items()}}
+        self.blocks = [(block, Template(block['source']), [Template(d) for d in ingest.destinations(block)]) for block in self.config['ingest']]
+        self.files = {block['name']: list(self.scan(source)) for block, source, _ in self.blocks}
+
+    def scan(self, source: Template) -> t.Iterator:
+        path, pattern = longest_path_part(source.render(UnionDict(self.context)))
+        return re_glob(Path(path), f'^{path}{pattern}$')
+
+    def all_files(self) -> list[tuple[str, PathMatch]]:
+        return [(name, match) for name, matches in self.files.items() for match in matches]
+
+
+def bench_scan(tree: Tree) -> tuple[int, float]:
+    start = time.perf_counter()
+    count = sum(1 for _, source, _ in tree.blocks for _ in tree.scan(source))
+    return count, time.perf_counter() - start
+
+
+def bench_dedup(tree: Tree, batch: int = 256) -> tuple[int, float]:
+    '''Check every file against a db that already has every other file, in batches like the filter stage'''
+    files = tree.all_files()
+    with tempfile.TemporaryDirectory() as tmp:
+        ingest.DB_FILE = str(Path(tmp) / 'ingest.db')
+        db = ingest.load_db()
+        with db:
+            db.execute('BEGIN')
+            db.executemany('INSERT INTO files (ingest_block_name, source, destination, size, mtime) VALUES (?, ?, ?, ?, ?)', (
+                (name, str(match.path), str(match.path), match.stat.st_size, match.stat.st_mtime_ns) for name, match in files[::2]
+            ))
+        candidates = [(name, str(match.path), match.stat.st_size, match.stat.st_mtime_ns, match.stat.st_mtime, 1) for name, match in files]
+
+        start = time.perf_counter()
+        existing = set()
+        for i in range(0, len(candidates), batch):
+            existing |= find_existing(db, candidates[i:i + batch])
+        elapsed = time.perf_counter() - start
+        db.close()
+
+    assert len(existing) == len(files[::2])
+    return len(files), elapsed
+
+
+def bench_metadata(tree: Tree) -> tuple[int, float]:
+    '''Read the date of every file from its exif or mp4 header'''
+    files = [match.path for _, match in tree.all_files()]
+    start = time.perf_counter()
+    for path in files:
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            if path.suffix.lower() == '.jpg':
+                tags = exif.load(buf)
+                tags['DateTime']
+                tags.release()
+            else:
+                mp4.load(buf)['creation_time']
+    return len(files), time.perf_counter() - start
+
+
+def bench_render(tree: Tree) -> tuple[int, float]:
+    '''Render the destination of every file, with its metadata already read'''
+    contexts = []
+    for name, match in tree.all_files():
+        destinations = next(d for block, _, d in tree.blocks if block['name'] == name)
+        date = datetime.datetime.fromtimestamp(match.stat.st_mtime, datetime.timezone.utc)
+        context = {'m': match.match, 'ext': match.path.suffix.lower(), 'exif': {'DateTime': date}, 'mp4': {'creation_time': date}}
+        contexts.append((destinations, context))
+
+    start = time.perf_counter()
+    for destinations, context in contexts:
+        for destination in destinations:
+            destination.render(UnionDict(tree.context, context))
+    return len(contexts), time.perf_counter() - start
+
+
+def bench_ingest(tree: Tree) -> tuple[int, float]:
+    '''A whole ingest into an empty destination and db'''
+    with tempfile.TemporaryDirectory(dir=tree.root) as tmp:
+        ingest.DB_FILE = str(Path(tmp) / 'ingest.db')
+        config = parse((tree.root / 'ingest.toml').read_text())
+        config['var']['media'] = str(Path(tmp) / 'out')
+        db = ingest.load_db()
+        ingest_tool = ingest.IngestTool(config, db)
+        start = time.perf_counter()
+        ingest_tool.ingest()
+        elapsed = time.perf_counter() - start
+        db.close()
+    return sum(len(files) for files in tree.files.values()), elapsed
+
+
+def git_revision() -> t.Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(tree: Tree, names: list[str], repeat: int) -> dict:
+    results = {}
+    for name in names:
+        bench = globals()[f'bench_{name}']
+        runs = []
+        for _ in range(repeat):
+            count, elapsed = bench(tree)
+            runs.append(count / elapsed)
+        results[name] = {'unit': 'files/s', 'files': count, 'runs': runs, 'median': statistics.median(runs), 'best': max(runs)}
+        print(f'{name:<10} {results[name]["median"]:>12,.0f} files/s (best {results[name]["best"]:,.0f}, {count} files)')
+    return results
+
+
+def compare(results: dict, previous: dict):
+    print(f'\nCompared to {previous["meta"].get("revision")} ({previous["meta"].get("date")}):')
+    for name, result in results.items():
+        if name in previous['results']:
+            before = previous['results'][name]['median']
+            print(f'{name:<10} {before:>12,.0f} -> {result["median"]:>12,.0f} files/s ({(result["median"] / before - 1) * 100:+.1f}%)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('root', type=Path, help='Tree generated by bench/generate.py')
+    parser.add_argument('--only', help=f'Comma separated benchmarks to run (default: all of {",".join(BENCHMARKS)})')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of each benchmark (default: 3)')
+    parser.add_argument('--output', type=Path, help='Where to save the results (default: bench/results/<date>-<revision>.json)')
+    parser.add_argument('--compare', type=Path, help='Earlier results to compare against')
+    args = parser.parse_args()
+
+    names = args.only.split(',') if args.only else list(BENCHMARKS)
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f'Unknown benchmarks: {", ".join(sorted(unknown))}')
+    logging.basicConfig(level=logging.WARNING)
+
+    tree = Tree(args.root.resolve())
+    revision = git_revision()
+    meta = {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'revision': revision,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'files': {name: len(files) for name, files in tree.files.items()},
+        'bytes': sum(match.stat.st_size for _, match in tree.all_files()),
+    }
+    results = run(tree, names, max(1, args.repeat))
+
+    output = args.output or REPO / 'bench' / 'results' / f'{datetime.datetime.now():%Y%m%d-%H%M%S}-{revision or "unknown"}.json'
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps({'meta': meta, 'results': results}, indent=2))
+    print(f'\nSaved to {output}')
+
+    if args.compare:
+        compare(results, json.loads(args.compare.read_text()))
+
+
+if __name__ == '__main__':
+    main()
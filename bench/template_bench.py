@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+'''Micro-benchmark for utils.template: renders per second of the example destination templates'''
+
+import argparse
+from pathlib import Path
+import re
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils.template import Template
+from utils.utils import UnionDict
+
+VAR = {
+    'media': '/mnt/fast/media',
+    'dest_folder': '''
+{{ var['media'] }} /
+{{ date.strftime('%Y') }} /
+{{ date.strftime('%m_%B').lower() }}
+''',
+    'dest_datetime': '''{{ date.strftime('%Y-%m-%d') }}_{{ date.strftime('%H-%M-%S') }}''',
+}
+
+DESTINATION = '''
+{% date = datetime.strptime(f'{m[1]}{m[2]}', '%Y%m%d%H%M%S') %}
+{{ var['dest_folder'] }} /
+{{ var['dest_datetime'] }}{{ f'_{m[3]}' if m[3] else '' }}{{ ext }}
+'''
+
+
+def bench(seconds: float) -> tuple[int, float]:
+    context = {'var': {k: Template(v) for k, v in VAR.items()}}
+    destination = Template(DESTINATION)
+    match = re.match(r'(\d{8})_(\d{6})(?:_(\d+))?\.(jpg|mp4)', '20230517_120102_1.jpg')
+
+    renders = 0
+    start = time.perf_counter()
+    while (elapsed := time.perf_counter() - start) < seconds:
+        destination.render(UnionDict(context, {'m': match, 'ext': '.jpg'}))
+        renders += 1
+    return renders, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--seconds', type=float, default=3.0, help='How long to render for')
+    args = parser.parse_args()
+
+    renders, elapsed = bench(args.seconds)
+    print(f'{renders / elapsed:,.0f} renders/s ({renders} renders in {elapsed:.2f}s)')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,64 +1,230 @@
 #!/usr/bin/env python3
 
-import copy
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 import datetime
 import io
+import itertools
 import json
 from pathlib import Path
-from contextlib import nullcontext
+from contextlib import ExitStack, contextmanager, nullcontext
 import re
 import logging
+import marshal
+import os
 import sqlite3
-import subprocess
 import sys
+import threading
+import time
+import typing as t
 from typing import TypedDict
 import mmap
 
-from tomlkit import parse
-from tqdm import tqdm
-from tqdm.contrib.logging import logging_redirect_tqdm
 
-from utils.path import PathMatch, longest_path_part, re_glob
+from utils.path import PathMatch, device_label, device_of, longest_path_part, re_glob
 from utils.template import Template
-from utils.copy import copy_with_callback
-from utils.bar import bytes_bar, simple_bar
+from utils.config_cache import ConfigCache
+from utils.copy import DEFAULT_BACKENDS, tee, transfer
+from utils.bar import bytes_bar
 from utils.utils import UnionDict
-from utils import exif
+from utils.limits import DeviceLimiter
+from utils.hashing import hash_file, new_hasher
+from utils.db import INGEST_BLOCK_NAME, BatchWriter, find_existing
+from utils.cache import MetadataCache
+from utils.scan_index import RACY_NS, ScanIndex
+from utils.dest_index import DestinationIndex, counter_names
+from utils.watch import Watcher, watcher
+from utils.content_index import ContentIndex, partial_hash
+from utils.read_order import READ_ORDERS, read_position
+from utils.durability import DURABILITY, SyncGroups, preallocate, sync_directory
+from utils.ffprobe import ProbePool, probe, show_entries
+from utils.pipeline import DeviceQueue, Pipeline
+from utils.metrics import Metrics
+from utils.profiling import profile
+from utils.resume import Checkpoints, ChunkHasher, part_path, verify_part
+from utils.query import WRITERS, query
+from utils.plan import SKIP_COLLISION, SKIP_DUPLICATE_SOURCE, SKIP_EXISTS, SKIP_EXISTS_DIFFERENT_SIZE, SKIP_INGESTED, Plan
+from utils import exif, mp4
+
+if t.TYPE_CHECKING:
+    from tqdm import tqdm
 
 CONFIG_FILE = 'ingest.toml'
 DB_FILE = 'ingest.db'
 
+DEFAULT_SETTINGS = {
+    # Number of files copied at the same time
+    'workers': 4,
+    # Ingest sources scanned at the same time
+    'scan_workers': 4,
+    # Files read for metadata and rendered at the same time, ahead of the copies
+    'prepare_workers': 4,
+    # Max files waiting between two stages of the ingest pipeline
+    'queue_size': 64,
+    # Files checked against the database at a time
+    'filter_batch': 256,
+    # Max concurrent files per source device (st_dev), keeps SD cards from thrashing
+    'source_device_limit': 1,
+    # Max concurrent files per destination device (st_dev)
+    'destination_device_limit': 2,
+    # Transfer backends to try in order, see utils.copy.BACKENDS
+    'transfer_backends': list(DEFAULT_BACKENDS),
+    # Hash algorithm for the digest stored in the db (sha1, sha256, blake2b, md5 or xxhash), or "" to not hash
+    'hash': 'sha1',
+    # Re-read every copied file from disk (bypassing the page cache) and compare it to the digest
+    'verify': False,
+    # Copied files are written to the db in one transaction per this many files, or this many seconds
+    'db_flush_files': 500,
+    'db_flush_seconds': 5.0,
+    # Max size in bytes of the exif/ffprobe cache kept in the db, 0 to disable it
+    'metadata_cache_size': 256 * 1024 * 1024,
+    # Max ffprobe processes running at the same time
+    'ffprobe_workers': 4,
+    # Only probe the ffprobe entries the templates use (-show_entries), instead of everything
+    'ffprobe_narrow': True,
+    # Copies of files bigger than this are checkpointed every this many bytes, so an interrupted copy
+    # can resume from the last good chunk. 0 to always start over
+    'checkpoint_size': 64 * 1024 * 1024,
+    # Buffers (of 4 MiB) shared between the destinations of a block with more than one destination,
+    # the fastest destination can get this far ahead of the slowest
+    'tee_buffers': 8,
+    # Remember the listing of every scanned directory, and only list again the ones whose mtime changed
+    'scan_index': False,
+    # What to do when a destination already exists with a different size, or is also the destination of
+    # another file: 'skip' the file, or 'counter' to write it to the next free name (IMG_0001_1.jpg, ...)
+    'destination_conflict': 'skip',
+    # Watch mode: files (and directories) are only ingested once they haven't changed for this many
+    # seconds, so files that are still being written are left for later
+    'watch_settle': 2.0,
+    # Watch mode: how often to look for changes when inotify can't be used
+    'watch_poll_interval': 5.0,
+    # What to do with a file whose content is already archived (found on the same device as a
+    # destination, e.g. copied before from another source): 'off' to copy it anyway, 'hardlink' or
+    # 'reflink' the archived file to the destination (falling back to copying), or 'record' it in the
+    # db as ingested to the archived file without writing anything
+    'content_dedup': 'off',
+    # Order the files of each source device are copied in (can be set per ingest block): 'physical'
+    # by where they are on the device, 'inode' by inode number, or 'scan' in the order they're found
+    'read_order': 'physical',
+    # Bytes of the next file of a device to read ahead into the page cache while the current one copies, 0 to disable
+    'read_ahead': 8 * 1024 * 1024,
+    # How copies are made durable before they're recorded in the db: 'none' leaves it to the OS (a
+    # power loss can lose files the db says are ingested), 'fsync' syncs every file, 'batch' fsyncs
+    # them in groups and 'syncfs' syncs the destination's filesystem once per group
+    'durability': 'batch',
+    # Destination path prefix -> durability for the destinations under it, overriding 'durability'
+    'destination_durability': {},
+    # A group is synced once it has this many files, or bytes (or is db_flush_seconds old)
+    'sync_batch_files': 256,
+    'sync_batch_bytes': 1024 * 1024 * 1024,
+    # Reserve the space of a copy before writing it (fallocate), for less fragmented destinations
+    'preallocate': True,
+}
+
 class IngestBlock:
     name: str
     source: str
-    destination: str
+    # One template, or a list of them to copy each file to all of them
+    destination: t.Union[str, list[str]]
     exif: bool
+    # Overrides the read_order setting for this block
+    read_order: str
 
-@dataclass
+# One of these is alive for every file between the scan and record stages, so no __dict__
+@dataclass(slots=True)
 class IngestFile:
     ingest_block: IngestBlock
 
     source: PathMatch
-    destination: Template
+    destinations: list[Template]
 
-    destination_path: Path = None
+    destination_paths: list[Path] = None
+    # Partial hash of the source (see ContentIndex), when deduplicating by content
+    partial: bytes = None
+    # Sort key of the source among the files copied from its device (see read_position)
+    read_position: tuple = ()
 
-def load_config():
-    with open('ingest.toml', 'r') as f:
-        config = parse(f.read())
-        return config
+def destinations(ingest_block: IngestBlock) -> list[str]:
+    '''The destination templates of an ingest block, which can have one or a list of them'''
+    destination = ingest_block['destination']
+    return [destination] if isinstance(destination, str) else list(destination)
+
+def load_config(cache: ConfigCache = None) -> dict:
+    '''Load the config, from its cache if it hasn't changed since it was cached'''
+    config = cache.load() if cache is not None else None
+    if config is None:
+        # Only imported when the config has to be parsed, it's slow to import
+        from tomlkit import parse
+        with open(CONFIG_FILE, 'r') as f:
+            config = parse(f.read()).unwrap()
+    return config
     
 def load_db():
-    db = sqlite3.connect(DB_FILE, isolation_level=None)
+    db = sqlite3.connect(DB_FILE, isolation_level=None, check_same_thread=False)
     db.execute('pragma journal_mode=wal;')
     cur = db.cursor()
-    cur.execute('CREATE TABLE IF NOT EXISTS files (ingest_block_name TEXT NOT NULL, source TEXT NOT NULL, size INTEGER NOT NULL, mtime datetime NOT NULL, sha1 BLOB, destination TEXT, PRIMARY KEY(ingest_block_name, source, size, mtime))')
+    # The sha1 column holds the digest of whatever hash_algorithm was configured when the file was copied.
+    # A file copied to several destinations has a row for each of them. ingested_at is when it was copied
+    # (in ns since the epoch), NULL for rows from before it was recorded. destinations is how many of the
+    # file's destinations a row stands for, when several were recorded as the same archived file (NULL is one)
+    files_table = 'CREATE TABLE IF NOT EXISTS {} (ingest_block_name TEXT NOT NULL, source TEXT NOT NULL, size INTEGER NOT NULL, mtime datetime NOT NULL, sha1 BLOB, destination TEXT NOT NULL, hash_algorithm TEXT, ingested_at INTEGER, destinations INTEGER, PRIMARY KEY(ingest_block_name, source, size, mtime, destination))'
+    cur.execute(files_table.format('files'))
+    columns = {row[1]: row for row in cur.execute('pragma table_info(files)')}
+    if 'hash_algorithm' not in columns:
+        cur.execute('ALTER TABLE files ADD COLUMN hash_algorithm TEXT')
+    if 'ingested_at' not in columns:
+        cur.execute('ALTER TABLE files ADD COLUMN ingested_at INTEGER')
+    if 'destinations' not in columns:
+        cur.execute('ALTER TABLE files ADD COLUMN destinations INTEGER')
+    # Older dbs had one destination per file, with destination not in the primary key
+    if columns['destination'][5] == 0:
+        with db:
+            cur.execute('BEGIN')
+            cur.execute(files_table.format('files_new'))
+            cur.execute('INSERT INTO files_new SELECT ingest_block_name, source, size, mtime, sha1, COALESCE(destination, \'\'), hash_algorithm, ingested_at, destinations FROM files')
+            cur.execute('DROP TABLE files')
+            cur.execute('ALTER TABLE files_new RENAME TO files')
+    # For `main.py query`, lookups by source use the primary key
+    for column in ('destination', 'sha1', 'ingested_at'):
+        cur.execute(f'CREATE INDEX IF NOT EXISTS files_{column} ON files ({column})')
     return db
 
+class Settings(TypedDict):
+    workers: int
+    scan_workers: int
+    prepare_workers: int
+    queue_size: int
+    filter_batch: int
+    source_device_limit: int
+    destination_device_limit: int
+    transfer_backends: list[str]
+    hash: str
+    verify: bool
+    db_flush_files: int
+    db_flush_seconds: float
+    metadata_cache_size: int
+    ffprobe_workers: int
+    ffprobe_narrow: bool
+    checkpoint_size: int
+    tee_buffers: int
+    scan_index: bool
+    destination_conflict: t.Literal['skip', 'counter']
+    watch_settle: float
+    watch_poll_interval: float
+    content_dedup: t.Literal['off', 'hardlink', 'reflink', 'record']
+    read_order: t.Literal['physical', 'inode', 'scan']
+    read_ahead: int
+    durability: t.Literal['none', 'fsync', 'batch', 'syncfs']
+    destination_durability: dict[str, str]
+    sync_batch_files: int
+    sync_batch_bytes: int
+    preallocate: bool
+
 class Config(TypedDict):
     ingest: list[IngestBlock]
     var: dict[str, str]
+    settings: Settings
 
 class Tz(datetime.tzinfo):
     def __init__(self, offset: datetime.timedelta):
@@ -71,59 +237,123 @@ class Tz(datetime.tzinfo):
         return self.offset
 
 class DestinationContext(dict):
-    def __init__(self, ingest_file: IngestFile, f: io.BufferedIOBase) -> None:
+    def __init__(self, ingest_file: IngestFile, f: io.BufferedIOBase, cache: MetadataCache = None, probes: ProbePool = None, probe_entries: str = None, exif_tags: t.Optional[frozenset[str]] = frozenset()) -> None:
         
         self.ingest_file = ingest_file
         self.f = f
+        self.cache = cache
+        self.probes = probes
+        self.probe_entries = probe_entries
+        # The exif tags the templates use (see exif.used_tags), they're cached whatever their size
+        self.exif_tags = exif_tags
 
         self._exif = None
         self._ffprobe = None
+        self._mp4 = None
+        self._exif_tags: exif.ExifTags = None
+        # Time spent reading each kind of metadata (exif, ffprobe, mp4) for this file
+        self.metadata_seconds: dict[str, float] = {}
 
-    def get_exif(self):
-        raw = exif.load(self.f)
+    def _timed(self, kind: str, get):
+        start = time.perf_counter()
+        try:
+            return get()
+        finally:
+            self.metadata_seconds[kind] = self.metadata_seconds.get(kind, 0.0) + time.perf_counter() - start
 
-        data = {}
+    def _cached(self, kind: str, load, dumps, loads):
+        if self.cache is None:
+            return load()
+        source = self.ingest_file.source
+        return self.cache.cached(str(source.path), source.stat.st_size, source.stat.st_mtime_ns, kind, load, dumps, loads)
 
-        for key in raw['0th'].keys():
-            data[exif.TAGS['Image'][key]['name']] = raw['0th'][key]
+    def load_exif(self):
+        return exif.load(self.f)
+
+    def _exif_value(self, tags, key: str):
+        value = tags[key]
 
-        for key in raw['Exif'].keys():
-            data[exif.TAGS['Exif'][key]['name']] = raw['Exif'][key]
-        
         # TODO: Does this apply for all cameras?
-        if 'DateTime' in data:
-            data['DateTime'] = datetime.datetime.strptime(data['DateTime'].decode('utf-8'), '%Y:%m:%d %H:%M:%S').replace(tzinfo=datetime.timezone.utc)
-            if 'OffsetTime' in data:
-                m = re.match(r'([+-])(\d{2}):(\d{2})', data['OffsetTime'].decode('utf-8'))
+        if key == 'DateTime':
+            value = datetime.datetime.strptime(value.decode('utf-8'), '%Y:%m:%d %H:%M:%S').replace(tzinfo=datetime.timezone.utc)
+            if 'OffsetTime' in tags:
+                m = re.match(r'([+-])(\d{2}):(\d{2})', tags['OffsetTime'].decode('utf-8'))
                 if m:
                     offset = datetime.timedelta(hours=int(m.group(2)), minutes=int(m.group(3)))
                     if m.group(1) == '-':
                         offset = -offset
 
-                    data['DateTime'] = data['DateTime'].astimezone(Tz(offset))
-        
-        return data
-    
+                    value = value.astimezone(Tz(offset))
+
+        return value
+
+    def get_exif(self):
+        # Tags are decoded when the template uses them. Only the small ones and the ones the templates
+        # use are cached, they are plain bytes/ints/tuples so marshal can store them
+        def dumps(tags: exif.ExifTags) -> t.Optional[bytes]:
+            cached = tags.small(self.exif_tags or ())
+            # Templates that use the tags as a whole would render differently without the ones left out
+            if self.exif_tags is None and len(cached) < len(tags):
+                return None
+            return marshal.dumps(cached)
+
+        # What is cached depends on the tags the templates use, so that's part of the kind
+        kind = 'exif:*' if self.exif_tags is None else f'exif:{",".join(sorted(self.exif_tags))}'
+        tags = self._cached(kind, self.load_exif, dumps, marshal.loads)
+        if isinstance(tags, exif.ExifTags):
+            self._exif_tags = tags
+        return exif.LazyDict(tags, lambda key: self._exif_value(tags, key))
+
+    def close(self):
+        '''Release the exif data, which points into the source file mmap'''
+        if self._exif_tags is not None:
+            self._exif_tags.release()
+            self._exif_tags = None
+        self._exif = None
+
+    def _load_cached_ffprobe(self):
+        # A narrowed probe only has some entries, so it's cached separately from a full one
+        kind = 'ffprobe' if self.probe_entries is None else f'ffprobe:{self.probe_entries}'
+        return self._cached(kind, self.load_ffprobe, lambda data: json.dumps(data).encode('utf-8'), lambda data: json.loads(data.decode('utf-8')))
+
     def get_ffprobe(self):
-        cmd = ['ffprobe', '-hide_banner', '-loglevel', 'fatal', '-show_error', '-show_format', '-show_streams', '-show_programs', '-show_chapters', '-show_private_data', '-print_format', 'json', self.ingest_file.source.path]
-        output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-        return json.loads(output.decode('utf-8'))
+        if self.probes is None:
+            return self._load_cached_ffprobe()
+        return self.probes.probe(str(self.ingest_file.source.path), self.probe_entries, self._load_cached_ffprobe)
+
+    def prefetch_ffprobe(self):
+        if self.probes is not None:
+            self.probes.prefetch(str(self.ingest_file.source.path), self.probe_entries, self._load_cached_ffprobe)
+
+    def load_ffprobe(self):
+        return probe(self.ingest_file.source.path, self.probe_entries)
+
+    def get_mp4(self):
+        '''MP4/MOV header data, or an empty dict for other files so templates can fall back to ffprobe'''
+        try:
+            return mp4.load(self.f)
+        except mp4.InvalidMP4Error:
+            return {}
 
     def __getitem__(self, key):
         if key == 'stat':
-            return self.ingest_file.stat
+            return self.ingest_file.source.stat
         elif key == 'm':
             return self.ingest_file.source.match
         elif key == 'ext':
             return self.ingest_file.source.path.suffix.lower()
         elif key == 'exif':
             if self._exif is None:
-                self._exif = self.get_exif()
+                self._exif = self._timed('exif', self.get_exif)
             return self._exif
         elif key == 'ffprobe':
             if self._ffprobe is None:
-                self._ffprobe = self.get_ffprobe()
+                self._ffprobe = self._timed('ffprobe', self.get_ffprobe)
             return self._ffprobe
+        elif key == 'mp4':
+            if self._mp4 is None:
+                self._mp4 = self._timed('mp4', self.get_mp4)
+            return self._mp4
         else:
             return super().__getitem__(key)
 
@@ -132,106 +362,968 @@ class IngestTool:
         self.config: Config = config
         self.db = db
         self.context = {'var': {k: Template(v) for k, v in self.config['var'].items()}}
+        # (ingest block, source template, destination templates)
+        self.blocks = [(block, Template(block['source']), [Template(d) for d in destinations(block)]) for block in self.config['ingest']]
+        self._blocks_by_name = {block['name']: (block, block_destinations) for block, _, block_destinations in self.blocks}
         self.logger = logging.getLogger('ingest')
+        self.settings: Settings = {**DEFAULT_SETTINGS, **self.config.get('settings', {})}
+        # Checked up front, a bad value would otherwise only show once files have been copied
+        for mode in (self.settings['durability'], *self.settings['destination_durability'].values()):
+            if mode not in DURABILITY:
+                raise ValueError(f'Unknown durability: {mode} (expected one of {", ".join(DURABILITY)})')
+        for strategy in (self.settings['read_order'], *(block['read_order'] for block, _, _ in self.blocks if 'read_order' in block)):
+            if strategy not in READ_ORDERS:
+                raise ValueError(f'Unknown read order: {strategy} (expected one of {", ".join(READ_ORDERS)})')
+
+        self.devices = DeviceLimiter({'destination': self.settings['destination_device_limit']})
+        # Guards the shared progress bar and the set of claimed destinations
+        self._lock = threading.Lock()
+        # Destination path -> the source that will be copied to it
+        self._claimed_destinations: dict[Path, Path] = {}
+        self.destination_index = DestinationIndex()
+        # Guards the db connection, which is shared between workers
+        self._db_lock = threading.Lock()
+        self.db_writer = BatchWriter(
+            self.db,
+            'INSERT OR REPLACE INTO files (ingest_block_name, source, destination, size, mtime, sha1, hash_algorithm, ingested_at, destinations) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            max_rows=int(self.settings['db_flush_files']),
+            max_seconds=float(self.settings['db_flush_seconds']),
+            lock=self._db_lock,
+        )
+        self.metrics = Metrics()
+        # Rows of copies only get to the db writer once the copies are durable
+        self.sync_groups = SyncGroups(
+            self.db_writer.add,
+            max_files=int(self.settings['sync_batch_files']),
+            max_bytes=int(self.settings['sync_batch_bytes']),
+            max_seconds=float(self.settings['db_flush_seconds']),
+            metrics=self.metrics,
+        )
+        # Longest first, so the most specific prefix wins
+        self._destination_durability = sorted(((Path(prefix), mode) for prefix, mode in self.settings['destination_durability'].items()), key=lambda item: len(item[0].parts), reverse=True)
+        self.metadata_cache = MetadataCache(
+            self.db,
+            self._db_lock,
+            max_bytes=int(self.settings['metadata_cache_size']),
+            flush_rows=int(self.settings['db_flush_files']),
+            flush_seconds=float(self.settings['db_flush_seconds']),
+            metrics=self.metrics,
+        )
+        self.checkpoints = Checkpoints(self.db, self._db_lock, int(self.settings['checkpoint_size']))
+        self.content_index = ContentIndex(
+            self.db,
+            self._db_lock,
+            # Digests are reused from the copies when they're hashed anyway
+            self.settings['hash'] or 'sha1',
+            flush_rows=int(self.settings['db_flush_files']),
+            flush_seconds=float(self.settings['db_flush_seconds']),
+        ) if self.settings['content_dedup'] != 'off' else None
+        # (size, partial hash) -> set once the file with that content that is being copied is done
+        self._copying_content: dict[tuple[int, bytes], threading.Event] = {}
+        self.scan_index = ScanIndex(
+            self.db,
+            self._db_lock,
+            max_pending=int(self.settings['db_flush_files']),
+            metrics=self.metrics,
+            # Files that haven't settled yet may still be being written, their stats aren't stored either
+            racy_ns=max(RACY_NS, round(float(self.settings['watch_settle']) * 1e9)),
+        ) if self.settings['scan_index'] else None
+        self.probes: ProbePool = None
+        # Exif tags used by any template, the metadata cache is shared by all blocks (see exif.used_tags)
+        self._exif_usage = exif.used_tags(set().union(*(
+            template.subscripts('exif') for template in [*(d for _, _, block_destinations in self.blocks for d in block_destinations), *self.context['var'].values()]
+        )))
+        # Destination templates of a block -> (whether to prefetch ffprobe for them, -show_entries for them)
+        self._probe_entries: dict[int, tuple[bool, str]] = {}
+        self._counts = {'existing': 0, 'new': 0}
+        # Source -> the block that found it first, only kept for the blocks in _overlapping_blocks
+        self._seen_sources: dict[Path, str] = {}
+        self._overlapping_blocks: set[str] = set()
+        # Sources between the filter and copy stages, so a rescan doesn't pick them up again
+        self._in_flight: set[Path] = set()
+        # Set while watching: files younger than this many seconds are left for later, see watch()
+        self._settle: float = None
+        self._deferred: set[str] = set()
+        # Queue of the copy stage, to read ahead the files in it
+        self._copy_queue: DeviceQueue = None
+        # Set while planning, see plan()
+        self._plan: Plan = None
+
+    def _ffprobe_usage(self, destinations: list[Template]) -> tuple[bool, str]:
+        '''Find whether the destination templates of a block need ffprobe, and which entries they use'''
+        if id(destinations) not in self._probe_entries:
+            # Var templates are rendered inside the destination ones, so they count too
+            templates = [*destinations, *self.context['var'].values()]
+            chains = set().union(*(t.subscripts('ffprobe') for t in templates))
+            entries = show_entries(chains) if self.settings['ffprobe_narrow'] else None
+            # When the template reads the mp4 header, ffprobe is usually only a fallback, so don't prefetch it
+            prefetch = bool(chains) and not any(t.subscripts('mp4') for t in templates)
+            self._probe_entries[id(destinations)] = (prefetch, entries)
+        return self._probe_entries[id(destinations)]
+
+    def _destination_context(self, file: IngestFile, f: mmap.mmap = None) -> DestinationContext:
+        _, entries = self._ffprobe_usage(file.destinations)
+        return DestinationContext(file, f, self.metadata_cache, self.probes, entries, self._exif_usage)
+
+    def _prefetch(self, file: IngestFile):
+        '''Start probing a file that will be processed soon'''
+        if self.probes is not None and self._ffprobe_usage(file.destinations)[0]:
+            self._destination_context(file).prefetch_ffprobe()
+
+    def _planned(self, file: IngestFile, destination: Path = None, skip: str = None, collision: Path = None):
+        '''Count a skipped file, and add the file to the plan if we're planning'''
+        if skip is not None:
+            self.metrics.count('files_skipped', block=file.ingest_block['name'], reason=skip)
+        if self._plan is not None:
+            self._plan.add(
+                file.ingest_block['name'], str(file.source.path), file.source.stat.st_size, file.source.stat.st_mtime_ns,
+                destination=str(destination) if destination is not None else None, skip=skip, collision=str(collision) if collision is not None else None,
+            )
+
+    def _observe(self, stage: str, block: str, seconds: float):
+        '''Record the time a stage spent on one file'''
+        self.metrics.observe('stage_seconds', seconds, stage=stage, block=block)
+        if self._plan is not None:
+            self._plan.add_time(stage, block, seconds)
+
+    def _timed(self, stage: str, block: str, iterable: t.Iterable) -> t.Generator:
+        '''Iterate over iterable, observing the time spent producing each item (not consuming it)'''
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._observe(stage, block, time.perf_counter() - start)
+            yield item
+
+    def _source_root(self, index: int) -> tuple[str, str]:
+        '''The path an ingest block's source is scanned from, and the pattern of the files under it'''
+        return longest_path_part(self.blocks[index][1].render(UnionDict(self.context)))
+
+    def scan_block(self, index: int) -> t.Generator[IngestFile, None, None]:
+        '''Scan the source of one ingest block for files that can be ingested'''
+        ingest_block, _, destinations = self.blocks[index]
+        path, pattern = self._source_root(index)
+        scandir = self.scan_index.scandir if self.scan_index else os.scandir
+        matches = re_glob(Path(path), f'^{path}{pattern}$', scandir=scandir)
+
+        file_count = 0
+        try:
+            for file_match in self._timed('scan', ingest_block['name'], matches):
+                yield IngestFile(ingest_block, source=file_match, destinations=destinations)
+                file_count += 1
+        except FileNotFoundError:
+            return
+
+        if file_count == 0:
+            self.logger.warning(f'No files found in ingest source: {ingest_block["name"]}')
+        else:
+            self.logger.info(f'Found {file_count} files in ingest source: {ingest_block["name"]}')
+        self.metrics.count('files_scanned', file_count, block=ingest_block['name'])
 
     def gather_files(self):
         '''Gather a list of all files that can be ingested'''
         files: dict[Path, IngestFile] = {}
 
-        for ingest_block in self.config['ingest']:
-            file_count = 0
+        # Scan all sources at the same time, they are often on different devices
+        with ThreadPoolExecutor(max_workers=self._scan_workers(), thread_name_prefix='scan') as executor:
+            results = list(executor.map(lambda index: list(self.scan_block(index)), range(len(self.blocks))))
 
-            source = Template(ingest_block['source']).render(UnionDict(copy.deepcopy(self.context)))
-            destination = Template(ingest_block['destination'])
-
-            path, pattern = longest_path_part(source)
+        for block_files in results:
+            for file in block_files:
+                files[file.source.path] = file
+        return files
 
-            try:
-                for file_match in re_glob(Path(path), f'^{path}{pattern}$'):
-                    files[file_match.path] = IngestFile(ingest_block, source=file_match, destination=copy.copy(destination))
-                    file_count += 1
-            except FileNotFoundError:
-                continue
-            
-            if file_count == 0:
-                self.logger.warning(f'No files found in ingest source: {ingest_block["name"]}')
+    def _new_files(self, files: t.Iterable[IngestFile]) -> list[IngestFile]:
+        '''Filter out files that already exist in our database'''
+        files = list(files)
+        with self._db_lock:
+            existing = find_existing(self.db, (
+                (INGEST_BLOCK_NAME, str(file.source.path), file.source.stat.st_size, file.source.stat.st_mtime_ns, file.source.stat.st_mtime, len(file.destinations))
+                for file in files
+            ))
+        new_files = []
+        for file in files:
+            if (INGEST_BLOCK_NAME, str(file.source.path)) in existing:
+                self._planned(file, skip=SKIP_INGESTED)
             else:
-                self.logger.info(f'Found {file_count} files in ingest source: {ingest_block["name"]}')
-        return files
+                self.metrics.count('files_new', block=file.ingest_block['name'])
+                new_files.append(file)
+        with self._lock:
+            self._counts['existing'] += len(files) - len(new_files)
+            self._counts['new'] += len(new_files)
+        return new_files
 
     def remove_existing(self, files: dict[Path, IngestFile]):
         '''Remove files that already exist in our database'''
-        cur = self.db.cursor()
-        for file in simple_bar(list(files.values()), desc='Checking for existing files'):
-            cur.execute('SELECT * FROM files WHERE ingest_block_name = ? AND source = ? AND size = ? AND mtime = ?', (file.ingest_block.name, str(file.source.path), file.source.stat.st_size, datetime.datetime.fromtimestamp(file.source.stat.st_mtime)))
-            if cur.fetchone() is not None:
-                del files[file.source.path]
-
-    def _process_file(self, file: IngestFile, bar: tqdm):
-        '''Process a single file'''
-        with file.source.path.open('rb') as f_source:
-            with mmap.mmap(f_source.fileno(), 0, access=mmap.ACCESS_READ) as f_mem:
-                self._prepare_file(file, f_mem, bar)
-                self.logger.debug(f'Copying {file.source.path} -> {file.destination_path}...')
-                self._copy_file(file, f_source, bar)
-
-    def _prepare_file(self, file: IngestFile, f: mmap.mmap, bar: tqdm):
-        # Get the destination path
-        context = DestinationContext(file, f)
-        file.destination_path = Path(file.destination.render(UnionDict(copy.deepcopy(self.context), context)))
-
-        # Check if the file already exists in the destination
-        if file.destination_path.exists():
-            # TODO: Implment a way to add a counter to the destination path if it already exists (e.g. IMG_0001.jpg -> IMG_0001_1.jpg)
-            bar.total -= file.source.stat.st_size
-            if file.destination_path.stat().st_size == file.source.stat.st_size:
-                # Skip the file if it already exists
-                self.logger.debug(f'{file.source.path} -> {file.destination_path} already exists in the destination and is same size. Skipping...')
-                return
+        new_files = {file.source.path for file in self._new_files(files.values())}
+        for path in list(files):
+            if path not in new_files:
+                del files[path]
+        self.logger.info(f'{self._counts["existing"]} files already ingested, {len(files)} new files')
+
+    def _filter_stage(self, files: list[IngestFile], bar: 'tqdm') -> list[IngestFile]:
+        '''Pipeline stage: drop files already in the database, or already found by another ingest block'''
+        start = time.perf_counter()
+        unique = []
+        now = time.time()
+        for file in files:
+            if self._settle is not None and now - max(file.source.stat.st_mtime, file.source.stat.st_ctime) < self._settle:
+                self.logger.debug(f'{file.source.path} was changed less than {self._settle}s ago, leaving it for later')
+                with self._lock:
+                    self._deferred.add(file.ingest_block['name'])
+                continue
+            if file.ingest_block['name'] not in self._overlapping_blocks:
+                other_block = file.ingest_block['name']
             else:
-                self.logger.warning(f'{file.source.path} -> {file.destination_path} already exists in the destination but is a different size. Skipping...')
-                return
-    
-    def _copy_file(self, file: IngestFile, f: io.BufferedReader, bar: tqdm):
+                with self._lock:
+                    other_block = self._seen_sources.setdefault(file.source.path, file.ingest_block['name'])
+            if other_block != file.ingest_block['name']:
+                self.logger.warning(f'{file.source.path} matches both ingest sources {other_block} and {file.ingest_block["name"]}, only ingesting it for {other_block}')
+                self._planned(file, skip=SKIP_DUPLICATE_SOURCE)
+                continue
+            unique.append(file)
+
+        new_files = self._new_files(unique)
+        with self._lock:
+            new_files = [file for file in new_files if file.source.path not in self._in_flight]
+            self._in_flight.update(file.source.path for file in new_files)
+            bar.total += sum(file.source.stat.st_size for file in new_files)
+            bar.set_postfix_str(f'{self._counts["new"]} new, {self._counts["existing"]} already ingested', refresh=False)
+            bar.refresh()
+        for file in new_files:
+            self._prefetch(file)
+
+        # The db is checked for the whole batch at once, so split its time over the files
+        seconds = (time.perf_counter() - start) / max(1, len(files))
+        for file in files:
+            self._observe('filter', file.ingest_block['name'], seconds)
+        return new_files
+
+    def _prepare_stage(self, file: IngestFile, bar: 'tqdm') -> t.Optional[IngestFile]:
+        '''Pipeline stage: read the metadata and render the destination path'''
+        try:
+            with file.source.path.open('rb') as f_source:
+                # Empty files can't be mmapped
+                with mmap.mmap(f_source.fileno(), 0, access=mmap.ACCESS_READ) if file.source.stat.st_size else nullcontext(b'') as f_mem:
+                    if not self._prepare_file(file, f_mem, bar):
+                        self._release(file)
+                        return None
+                    if self.content_index is not None:
+                        file.partial = partial_hash(f_mem, file.source.stat.st_size)
+                file.read_position = self._read_position(file, f_source.fileno())
+        except OSError as e:
+            self._failed(file, 'prepare', e)
+            self._skip_file(file, bar)
+            return None
+        return file
+
+    def _read_position(self, file: IngestFile, fd: int) -> tuple:
+        return read_position(file.ingest_block.get('read_order', self.settings['read_order']), fd, file.source.stat)
+
+    def _read_ahead(self, file: IngestFile):
+        '''Have the kernel start reading the file that is copied next from the same device, while this one copies'''
+        read_ahead = int(self.settings['read_ahead'])
+        next_file = self._copy_queue.peek(file.source.stat.st_dev) if read_ahead and self._copy_queue is not None else None
+        if next_file is None:
+            return
+        try:
+            fd = os.open(next_file.source.path, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.posix_fadvise(fd, 0, min(read_ahead, next_file.source.stat.st_size), os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+    def _release(self, file: IngestFile):
+        '''A file is done with, a rescan may pick it up again (if it isn't in the db by then)'''
+        with self._lock:
+            self._in_flight.discard(file.source.path)
+        if self.probes is not None:
+            # Its prefetched probe, if it was skipped (or failed) before it got to use it
+            self.probes.discard(str(file.source.path), self._ffprobe_usage(file.destinations)[1])
+
+    def _index_content(self, file: IngestFile, row: tuple, part: Path = None):
+        '''Add a copy to the content index, part is where it still is if its rename waits for its sync group'''
+        if self.content_index is not None:
+            self.content_index.add(Path(row[2]), row[3], file.partial, row[5] if row[6] == self.content_index.algorithm else None, part=part)
+
+    def _failed(self, file: IngestFile, stage: str, e: OSError):
+        '''A file couldn't be read or written (removed since the scan, card pulled out, ...), skip it and carry on with the others'''
+        self.logger.error(f'{file.source.path}: {stage} failed ({e}). Skipping...')
+        self.metrics.count(f'{stage}_errors', block=file.ingest_block['name'], reason=type(e).__name__)
+        # A later scan can pick it up again, with a fresh listing (and stat) of its directory
+        for path in file.destination_paths or ():
+            self._unclaim(path)
+        if self.scan_index is not None:
+            self.scan_index.forget(file.source.path.parent)
+        self._release(file)
+
+    def _copy_stage(self, file: IngestFile, bar: 'tqdm') -> list[tuple]:
+        '''Pipeline stage: copy the file, returns its database rows (one per destination)'''
+        rows = []
+        try:
+            with file.source.path.open('rb') as f_source, ExitStack() as stack:
+                os.posix_fadvise(f_source.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                self._read_ahead(file)
+                if self.content_index is not None:
+                    stack.enter_context(self._copying(file, f_source))
+                    rows = self._deduplicate(file)
+                    if not file.destination_paths:
+                        with self._lock:
+                            bar.update(file.source.stat.st_size)
+                        return rows
+
+                # Always taken in the same order, so two files going to the same devices can't deadlock
+                for device in sorted({self.destination_index.device(path) for path in file.destination_paths}):
+                    stack.enter_context(self.devices.limit('destination', device))
+                self.logger.debug(f'Copying {file.source.path} -> {", ".join(map(str, file.destination_paths))}...')
+                copied = self._copy_file(file, f_source, bar)
+                for row in copied:
+                    self._index_content(file, row)
+                return rows + copied
+        except OSError as e:
+            self._failed(file, 'copy', e)
+            # Destinations that were linked before it failed are there, they're still recorded
+            return rows
+        finally:
+            # The copies are in the destination index by now, so a rescan sees them even before they're in the db
+            self._release(file)
+
+    @contextmanager
+    def _copying(self, file: IngestFile, f: io.BufferedReader):
+        '''Only copy one file with the same content at a time, the others wait for it and then find its copies'''
+        if file.partial is None:
+            # Files from a plan weren't prepared
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if file.source.stat.st_size else nullcontext(b'') as f_mem:
+                file.partial = partial_hash(f_mem, file.source.stat.st_size)
+        key = (file.source.stat.st_size, file.partial)
+        while True:
+            with self._lock:
+                copying = self._copying_content.get(key)
+                if copying is None:
+                    copying = self._copying_content[key] = threading.Event()
+                    break
+            copying.wait()
+        try:
+            yield
+        finally:
+            with self._lock:
+                del self._copying_content[key]
+            copying.set()
+
+    def _deduplicate(self, file: IngestFile) -> list[tuple]:
+        '''Link the destinations of a file whose content is already archived on their device, returns their database rows.
+
+        They are taken out of file.destination_paths, the ones left still have to be copied.
+        '''
+        source, size, mtime = str(file.source.path), file.source.stat.st_size, file.source.stat.st_mtime_ns
+        method = self.settings['content_dedup']
+        digest = None
+
+        def source_digest() -> bytes:
+            nonlocal digest
+            if digest is None:
+                digest = hash_file(file.source.path, self.content_index.algorithm, drop_cache=False)
+            return digest
+
+        rows = []
+        # Archived path -> its row, when recorded. Destinations recorded as the same archived file share one row
+        recorded: dict[Path, list] = {}
+        remaining = []
+        for path in file.destination_paths:
+            found = self.content_index.find(size, file.partial, self.destination_index.device(path), source_digest)
+            if found is not None and self.content_index.renaming(found[0]):
+                # Copied earlier in this run and waiting for its sync group, only link to it once it's durable
+                self.sync_groups.flush()
+            if found is None or not self._link(found[0], path, method):
+                remaining.append(path)
+                continue
+            archived, archived_digest = found
+            self.logger.info(f'{source} is already archived as {archived}, {"recorded it" if method == "record" else f"{method}ed it to {path}"}')
+            self.metrics.count('files_deduplicated', block=file.ingest_block['name'], method=method)
+            self.metrics.count('bytes_deduplicated', size, block=file.ingest_block['name'], method=method)
+            self._unclaim(path)
+            row = [INGEST_BLOCK_NAME, source, str(path), size, mtime, archived_digest if self.settings['hash'] else None, self.settings['hash'] or None, time.time_ns(), None]
+            if method == 'record':
+                if archived in recorded:
+                    recorded[archived][8] += 1
+                    continue
+                row[2], row[8] = str(archived), 1
+                recorded[archived] = row
+            else:
+                self.destination_index.add(path, size)
+                self.content_index.add(path, size, file.partial, archived_digest)
+            rows.append(row)
+        file.destination_paths = remaining
+        return [tuple(row) for row in rows]
+
+    def _link(self, archived: Path, path: Path, method: str) -> bool:
+        '''Put an archived file at path with a hardlink or reflink, returns False if that can't be done'''
+        if method == 'record':
+            return True
+        self.destination_index.makedirs(path.parent)
+        part = part_path(path)
+        try:
+            if method == 'hardlink':
+                os.link(archived, path)
+            else:
+                with archived.open('rb') as f, part.open('wb') as df:
+                    transfer(f.fileno(), df.fileno(), archived.stat().st_size, backends=('reflink',))
+                os.replace(part, path)
+        except OSError as e:
+            # Most likely another filesystem than the archived file, or one without reflinks
+            self.logger.debug(f'Could not {method} {archived} -> {path} ({e}), copying it instead')
+            part.unlink(missing_ok=True)
+            return False
+        if self._durability(path) == 'fsync':
+            with path.open('rb') as f:
+                os.fsync(f.fileno())
+            sync_directory(path.parent)
+        return True
+
+    def _durability(self, path: Path) -> str:
+        '''How a file written to path is made durable, see the durability setting'''
+        return next((mode for prefix, mode in self._destination_durability if path == prefix or prefix in path.parents), self.settings['durability'])
+
+    def _record_stage(self, rows: list[tuple]):
+        '''Pipeline stage: add a copied file to the database, once it's durable'''
+        for row in rows:
+            path = Path(row[2])
+            self.sync_groups.add(row, path, row[3], self.destination_index.device(path), self._durability(path))
+
+    def _skip_file(self, file: IngestFile, bar: 'tqdm'):
+        with self._lock:
+            bar.total -= file.source.stat.st_size
+            bar.refresh()
+
+    def _prepare_file(self, file: IngestFile, f: mmap.mmap, bar: 'tqdm') -> bool:
+        '''Render the destination paths, returns False if the file should be skipped'''
+        # Get the destination paths, all rendered from the same metadata
+        start = time.perf_counter()
+        context = self._destination_context(file, f)
+        try:
+            paths = [Path(destination.render(UnionDict(self.context, context))) for destination in file.destinations]
+        finally:
+            context.close()
+        # Metadata is read while rendering, when the template first uses it
+        metadata_seconds = sum(context.metadata_seconds.values())
+        for kind, seconds in context.metadata_seconds.items():
+            self.metrics.observe('metadata_seconds', seconds, kind=kind, block=file.ingest_block['name'])
+        self._observe('metadata', file.ingest_block['name'], metadata_seconds)
+        self._observe('render', file.ingest_block['name'], time.perf_counter() - start - metadata_seconds)
+
+        file.destination_paths = self._claim_destinations(file, dict.fromkeys(paths))
+        if not file.destination_paths:
+            self._skip_file(file, bar)
+            return False
+        return True
+
+    def _claim_destinations(self, file: IngestFile, paths: t.Iterable[Path]) -> list[Path]:
+        '''Claim the destination paths of a file, returns the ones it should be written to'''
+        return [claimed for claimed in (self._claim_destination(file, path) for path in paths) if claimed is not None]
+
+    def _claim_destination(self, file: IngestFile, path: Path) -> t.Optional[Path]:
+        '''Claim a destination path for a file, returns the path to write it to, or None if it shouldn't be written'''
+        counter = self.settings['destination_conflict'] == 'counter'
+        size = file.source.stat.st_size
+        # List the directory before taking the lock, the lookups below are then all in memory
+        self.destination_index.load(path.parent)
+
+        # Claim the destination so two workers never write to the same path
+        with self._lock:
+            for candidate in counter_names(path) if counter else (path,):
+                claimed_by = self._claimed_destinations.setdefault(candidate, file.source.path)
+                if claimed_by != file.source.path:
+                    if counter:
+                        continue
+                    self.logger.warning(f'{file.source.path} -> {path} is also the destination of another file in this ingest. Skipping...')
+                    self._planned(file, path, skip=SKIP_COLLISION, collision=claimed_by)
+                    return None
+
+                # Check if the file already exists in the destination
+                existing_size = self.destination_index.size(candidate)
+                if existing_size is not None:
+                    # It's there already, the destination index takes over from the claim
+                    del self._claimed_destinations[candidate]
+                if existing_size == size:
+                    # Skip the file if it already exists
+                    self.logger.debug(f'{file.source.path} -> {candidate} already exists in the destination and is same size. Skipping...')
+                    self._planned(file, candidate, skip=SKIP_EXISTS)
+                    return None
+                if existing_size is not None:
+                    if counter:
+                        continue
+                    self.logger.warning(f'{file.source.path} -> {path} already exists in the destination but is a different size. Skipping...')
+                    self._planned(file, path, skip=SKIP_EXISTS_DIFFERENT_SIZE)
+                    return None
+
+                if candidate != path:
+                    self.logger.info(f'{file.source.path} -> {path} is taken, writing it to {candidate.name} instead')
+                return candidate
+
+    def _unclaim(self, path: Path):
+        '''A destination doesn't need its claim anymore: it was written (the destination index has it from now on), or its file failed'''
+        with self._lock:
+            self._claimed_destinations.pop(path, None)
+
+    def _resume(self, file: IngestFile, parts: list[Path], algorithm: str, hasher) -> tuple[int, t.Any]:
+        '''Find how much of the partial copies left by an interrupted run can be kept.
+
+        Returns that offset, and hasher fed with the bytes before it. The partial copies are cut to it.
+        '''
+        source = file.source
+        digests = self.checkpoints.load(str(source.path), source.stat.st_size, source.stat.st_mtime_ns, algorithm)
+        if not digests or not all(part.exists() for part in parts):
+            return 0, hasher
+
+        chunk_size = self.checkpoints.chunk_size
+        chunks = len(digests)
+        for part in parts[1:]:
+            chunks = min(chunks, verify_part(part, digests[:chunks], algorithm, chunk_size)[0] // chunk_size)
+        # The first one is read last, so the hasher only sees the chunks all of them have
+        offset, hasher = verify_part(parts[0], digests[:chunks], algorithm, chunk_size, hasher)
+        for part in parts:
+            os.truncate(part, offset)
+        return offset, hasher
+
+    def _copy_file(self, file: IngestFile, f: io.BufferedReader, bar: 'tqdm') -> list[tuple]:
+        '''Copy a file to all its destinations, reading it only once, returns the database rows of the good copies.
+
+        Copies are written to a temporary name next to the destination and renamed once complete, or
+        with batched durability once their sync group is synced (their rows are then recorded by the
+        group, not returned). Big files are checkpointed as they're copied, so an interrupted copy
+        resumes from its last good chunk.
+        '''
         # Make parent directories
-        file.destination_path.parent.mkdir(parents=True, exist_ok=True)
+        for path in file.destination_paths:
+            self.destination_index.makedirs(path.parent)
+        parts = [part_path(path) for path in file.destination_paths]
 
-        with file.destination_path.open('wb') as df:
-            blksize = file.source.stat.st_blksize
+        def progress(n: int, copied: int, total: int):
+            with self._lock:
+                bar.update(n)
 
+        source, size, mtime = str(file.source.path), file.source.stat.st_size, file.source.stat.st_mtime_ns
+        algorithm = self.settings['hash'] or None
+        hasher = new_hasher(algorithm) if algorithm else None
+
+        offset = 0
+        copy_hasher = hasher
+        checkpointed = self.checkpoints.wanted(size)
+        if checkpointed:
+            # Chunks are checked with the configured hash, or sha1 when there's none
+            checkpoint_algorithm = algorithm or 'sha1'
+            offset, hasher = self._resume(file, parts, checkpoint_algorithm, hasher)
+            if offset:
+                self.logger.info(f'Resuming {source} at {offset} of {size} bytes')
+                progress(offset, offset, size)
+            copy_hasher = ChunkHasher(
+                checkpoint_algorithm, self.checkpoints.chunk_size,
+                lambda chunk, digest: self.checkpoints.add(source, size, mtime, checkpoint_algorithm, chunk, digest),
+                hasher, first_chunk=offset // self.checkpoints.chunk_size,
+            )
+
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            dfs = [stack.enter_context(part.open('r+b' if offset else 'wb', buffering=0)) for part in parts]
+            if self.settings['preallocate']:
+                for df in dfs:
+                    preallocate(df.fileno(), size)
             # Copy the file
-            f.seek(0)
-            while True:
-                buf = f.read(blksize)
-                if not buf:
-                    break
-                df.write(buf)
-                bar.update(len(buf))
+            if len(dfs) == 1:
+                backend = transfer(f.fileno(), dfs[0].fileno(), size, callback=progress, backends=self.settings['transfer_backends'], offset=offset, hasher=copy_hasher)
+                errors = [None]
+            else:
+                backend = 'tee'
+                errors = tee(f.fileno(), [df.fileno() for df in dfs], size, callback=progress, buffers=int(self.settings['tee_buffers']), hasher=copy_hasher, offset=offset)
+            self.logger.debug(f'Copied {file.source.path} using {backend}')
+            for path, df, error in zip(file.destination_paths, dfs, errors):
+                if error is None and self._durability(path) == 'fsync':
+                    os.fsync(df.fileno())
+        seconds = time.perf_counter() - start
+
+        block = file.ingest_block['name']
+        source_device = device_label(file.source.stat.st_dev)
+        self._observe('copy', block, seconds)
+        self.metrics.observe('copy_seconds', seconds, block=block, source_device=source_device)
+        self.metrics.count('bytes_copied', size - offset, block=block, source_device=source_device)
+        self.metrics.count('files_copied', block=block, source_device=source_device, backend=backend)
+
+        digest = hasher.digest() if hasher is not None else None
+
+        rows = []
+        for path, part, error in zip(file.destination_paths, parts, errors):
+            destination_device = device_label(self.destination_index.device(path))
+            if error is not None:
+                self.metrics.count('copy_errors', block=block, destination_device=destination_device)
+                self.logger.error(f'{file.source.path} -> {path} failed: {error}. Keeping the partial copy to resume it next time...')
+                continue
+            if digest is not None and self.settings['verify']:
+                if hash_file(part, algorithm) != digest:
+                    self.logger.error(f'{file.source.path} -> {path} failed verification, the copy does not match the source. Removing it...')
+                    self.metrics.count('verify_errors', block=block, destination_device=destination_device)
+                    part.unlink()
+                    continue
+            row = (INGEST_BLOCK_NAME, source, str(path), size, mtime, digest, algorithm, time.time_ns(), None)
+            durability = self._durability(path)
+            if durability in ('batch', 'syncfs'):
+                # Only renamed once its group is synced, so the destination never has a name without the data
+                self._index_content(file, row, part)
+                self.sync_groups.add(row, path, size, self.destination_index.device(path), durability, part=part, done=None if self.content_index is None else lambda path=path: self.content_index.renamed(path))
+            else:
+                os.replace(part, path)
+                if durability == 'fsync':
+                    sync_directory(path.parent)
+                rows.append(row)
+            # Later files see it as there already, even while its rename waits for the sync
+            self.destination_index.add(path, size)
+            self._unclaim(path)
+            self.metrics.observe('write_seconds', seconds, destination_device=destination_device)
+            self.metrics.count('bytes_written', size - offset, destination_device=destination_device)
+
+        # Nothing left to resume
+        if checkpointed and not any(errors):
+            self.checkpoints.clear(source)
+        return rows
+
+    def _plan_stage(self, file: IngestFile, bar: 'tqdm'):
+        '''Pipeline stage: add a file that would be copied to the plan'''
+        for path in file.destination_paths:
+            self._planned(file, path)
+        self._release(file)
+        with self._lock:
+            bar.update(file.source.stat.st_size)
+
+    def _load_plan_stage(self, entries: list[dict], bar: 'tqdm') -> t.Optional[IngestFile]:
+        '''Pipeline stage: turn the planned copies of one source file back into an IngestFile'''
+        entry = entries[0]
+        if entry['block'] not in self._blocks_by_name:
+            self.logger.warning(f'{entry["source"]} was planned for ingest source {entry["block"]}, which is no longer in the config. Skipping...')
+            return None
+        ingest_block, destinations = self._blocks_by_name[entry['block']]
 
-            df.close()
+        path = Path(entry['source'])
+        try:
+            f = path.open('rb')
+        except FileNotFoundError:
+            self.logger.warning(f'{path} no longer exists. Skipping...')
+            return None
+        with f:
+            stat = os.fstat(f.fileno())
+            if stat.st_size != entry['size'] or stat.st_mtime_ns != entry['mtime']:
+                self.logger.warning(f'{path} has changed since it was planned. Skipping...')
+                return None
+            file = IngestFile(ingest_block, source=PathMatch(path, None, stat), destinations=destinations)
+            file.read_position = self._read_position(file, f.fileno())
 
-        # Add to database
-        cur = self.db.cursor()
-        cur.execute('INSERT INTO files (ingest_block_name, source, destination, size, mtime) VALUES (?, ?, ?, ?, ?)', (file.ingest_block.name, str(file.source.path), str(file.destination_path), file.source.stat.st_size, datetime.datetime.fromtimestamp(file.source.stat.st_mtime)))
+        with self._lock:
+            bar.total += stat.st_size
+            bar.refresh()
+        # The destinations may have been written since the plan was made
+        file.destination_paths = self._claim_destinations(file, (Path(entry['destination']) for entry in entries))
+        if not file.destination_paths:
+            self._skip_file(file, bar)
+            return None
+        return file
 
-    def process_files(self, files: dict[Path, IngestFile]):
-        '''Process the files'''
-        bar = bytes_bar(total=sum(file.source.stat.st_size for file in files.values()), desc='Processing files')
-        for file in files.values():
-            self._process_file(file, bar)
+    def _gather_stages(self, pipeline: Pipeline, bar: 'tqdm') -> Pipeline:
+        '''Add the scan -> filter stages to a pipeline, which takes ingest block indexes'''
+        return (pipeline
+            # Scan all sources at the same time, they are often on different devices
+            .add('scan', self.scan_block, workers=self._scan_workers(), flat=True)
+            .add('filter', lambda files: self._filter_stage(files, bar), batch=int(self.settings['filter_batch'])))
 
+    def _processing_stages(self, pipeline: Pipeline, bar: 'tqdm', prepare: t.Callable[[t.Any], t.Optional[IngestFile]] = None) -> Pipeline:
+        '''Add the prepare -> copy -> record stages to a pipeline'''
+        # Each device's files are copied in read order, see read_position
+        self._copy_queue = DeviceQueue(int(self.settings['queue_size']), key=lambda file: file.source.stat.st_dev, limit=int(self.settings['source_device_limit']), order=lambda file: file.read_position)
+        return (pipeline
+            .add('prepare', prepare or (lambda file: self._prepare_stage(file, bar)), workers=int(self.settings['prepare_workers']))
+            # Copies are scheduled per source device, so a busy SD card never blocks workers that could read another device
+            .add('copy', lambda file: self._copy_stage(file, bar), workers=int(self.settings['workers']), queue=self._copy_queue)
+            .add('record', self._record_stage))
+
+    @contextmanager
+    def _run(self):
+        self.probes = ProbePool(int(self.settings['ffprobe_workers']), self.metrics)
+        self._counts = {'existing': 0, 'new': 0}
+        self._seen_sources = {}
+        self._overlapping_blocks = self._find_overlapping_blocks()
+        self._in_flight = set()
+        # Anything may have been written to the destinations since the last run
+        self.destination_index = DestinationIndex()
+        try:
+            yield
+        finally:
+            self.probes.shutdown()
+            self.probes = None
+            self._flush()
+
+    def _flush(self):
+        '''Make the copies so far durable and write everything pending to the db, evicting from the metadata cache'''
+        self.sync_groups.flush()
+        self.db_writer.flush()
+        self.metadata_cache.flush()
+        if self.scan_index:
+            self.scan_index.flush()
+        if self.content_index:
+            self.content_index.flush()
+
+    def _find_overlapping_blocks(self) -> set[str]:
+        '''Names of the ingest blocks scanned from the same root as another block, or from inside it.
+
+        Only their files can be found by two blocks, so only theirs have to be remembered.
+        '''
+        roots = [Path(self._source_root(index)[0]) for index in range(len(self.blocks))]
+        names = set()
+        for i, j in itertools.combinations(range(len(roots)), 2):
+            if roots[i] == roots[j] or roots[i] in roots[j].parents or roots[j] in roots[i].parents:
+                names |= {self.blocks[i][0]['name'], self.blocks[j][0]['name']}
+        return names
+
+    def _scan_workers(self) -> int:
+        return max(1, min(len(self.blocks), int(self.settings['scan_workers'])))
+
+    def process_files(self, files: t.Union[dict[Path, IngestFile], t.Iterable[IngestFile]]):
+        '''Process the files, concurrently across devices.
+
+        files can be a generator, it's only consumed as fast as the pipeline takes the files in.
+        '''
+        bar = bytes_bar(total=0, desc='Processing files')
+
+        def counted(files: t.Iterable[IngestFile]) -> t.Iterator[IngestFile]:
+            for file in files:
+                with self._lock:
+                    bar.total += file.source.stat.st_size
+                    bar.refresh()
+                yield file
+
+        with self._run():
+            self._processing_stages(Pipeline(int(self.settings['queue_size'])), bar).run(counted(files.values() if isinstance(files, dict) else files))
+
+    def verify(self) -> bool:
+        '''Re-hash every copied file in the database and compare it to its stored digest'''
+        with self._db_lock:
+            rows = self.db.execute('SELECT destination, size, sha1, hash_algorithm FROM files WHERE sha1 IS NOT NULL AND destination IS NOT NULL').fetchall()
+        bar = bytes_bar(total=sum(row[1] for row in rows), desc='Verifying files')
+
+        def verify_file(destination: str, size: int, digest: bytes, algorithm: str) -> bool:
+            path = Path(destination)
+            try:
+                device = device_of(path)
+                with self.devices.limit('destination', device), self.metrics.timer('verify_seconds', destination_device=device_label(device)):
+                    actual = hash_file(path, algorithm or 'sha1')
+                self.metrics.count('bytes_verified', size, destination_device=device_label(device))
+            except FileNotFoundError:
+                self.logger.error(f'{path} is missing')
+                self.metrics.count('verify_errors', reason='missing')
+                return False
+            except OSError as e:
+                # Unreadable (permissions, a directory in its place, a failing device), the other files are still checked
+                self.logger.error(f'{path} could not be read: {e}')
+                self.metrics.count('verify_errors', reason=type(e).__name__)
+                return False
+            finally:
+                with self._lock:
+                    bar.update(size)
+
+            if actual != digest:
+                self.logger.error(f'{path} does not match its digest in the database')
+                self.metrics.count('verify_errors', reason='mismatch')
+                return False
+            return True
+
+        with ThreadPoolExecutor(max_workers=max(1, int(self.settings['workers'])), thread_name_prefix='verify') as executor:
+            results = list(executor.map(lambda row: verify_file(*row), rows))
+
+        failed = results.count(False)
+        if failed:
+            self.logger.error(f'{failed} of {len(results)} files failed verification')
+        else:
+            self.logger.info(f'All {len(results)} files verified')
+        return failed == 0
 
     def ingest(self):
-        files = self.gather_files()
-        self.remove_existing(files)
-        self.process_files(files)
+        '''Scan, filter, prepare, copy and record files as a pipeline, so metadata work runs ahead of the copies'''
+        bar = bytes_bar(total=0, desc='Processing files')
+        pipeline = self._gather_stages(Pipeline(int(self.settings['queue_size'])), bar)
+        with self._run():
+            self._processing_stages(pipeline, bar).run(range(len(self.blocks)))
+        self.logger.info(f'{self._counts["existing"]} files already ingested, {self._counts["new"]} new files')
+
+    def plan(self) -> Plan:
+        '''Scan, filter and render like ingest() does, but only record where each file would be copied, or why not'''
+        self._plan = Plan()
+        bar = bytes_bar(total=0, desc='Planning files')
+        pipeline = (self._gather_stages(Pipeline(int(self.settings['queue_size'])), bar)
+            .add('prepare', lambda file: self._prepare_stage(file, bar), workers=int(self.settings['prepare_workers']))
+            .add('plan', lambda file: self._plan_stage(file, bar)))
+        try:
+            with self._run():
+                pipeline.run(range(len(self.blocks)))
+            return self._plan
+        finally:
+            self._plan = None
+
+    def run_plan(self, plan: Plan):
+        '''Copy the files of a saved plan, without scanning or rendering them again'''
+        sources: dict[tuple[str, str], list[dict]] = {}
+        for entry in plan.copies():
+            sources.setdefault((entry['block'], entry['source']), []).append(entry)
+        bar = bytes_bar(total=0, desc='Processing files')
+        with self._run():
+            self._processing_stages(Pipeline(int(self.settings['queue_size'])), bar, prepare=lambda entries: self._load_plan_stage(entries, bar)).run(sources.values())
+        self.logger.info(f'{len(sources)} files in the plan')
+
+    def watch(self, poll: bool = False, report: t.Callable[[], None] = None):
+        '''Ingest new files as soon as they show up in the sources (a card is mounted, a phone synced), until interrupted.
+
+        Config, templates and db stay loaded between ingests, and they all go through one pipeline, so
+        files from different devices are copied at the same time. report is called whenever it's idle.
+        '''
+        # Source root -> the ingest blocks scanned from it
+        roots: dict[Path, list[int]] = {}
+        for index in range(len(self.blocks)):
+            roots.setdefault(Path(self._source_root(index)[0]), []).append(index)
+
+        self._settle = float(self.settings['watch_settle'])
+        bar = bytes_bar(total=0, desc='Processing files')
+        pipeline = self._processing_stages(self._gather_stages(Pipeline(int(self.settings['queue_size'])), bar), bar)
+        try:
+            with watcher(roots, float(self.settings['watch_poll_interval']), poll) as source_watcher, self._run():
+                self.logger.info(f'Watching {", ".join(map(str, roots))}')
+                pipeline.run(self._watch_jobs(source_watcher, roots, report))
+        except KeyboardInterrupt:
+            self.logger.info('Stopped watching')
+        finally:
+            self._settle = None
+
+    def _watch_jobs(self, source_watcher: Watcher, roots: dict[Path, list[int]], report: t.Callable[[], None] = None) -> t.Iterator[int]:
+        '''The indexes of the ingest blocks to scan, once the changes to their sources have settled'''
+        root_of = {self.blocks[index][0]['name']: root for root, indexes in roots.items() for index in indexes}
+        # Root -> when it last changed, everything is scanned once at the start
+        changed = {root: float('-inf') for root in roots}
+        while True:
+            now = time.monotonic()
+            # Blocks with files that were too new to ingest, look at them again once they have settled
+            with self._lock:
+                deferred, self._deferred = self._deferred, set()
+            for name in deferred:
+                changed.setdefault(root_of[name], now)
+
+            settled = [root for root, at in changed.items() if now - at >= self._settle]
+            if settled:
+                # Anything may have been written to the destinations in the meantime too
+                self.destination_index = DestinationIndex()
+            for root in settled:
+                del changed[root]
+                self.logger.debug(f'Changes in {root}, scanning it')
+                yield from roots[root]
+
+            # Nothing may come in for a while, don't keep what was copied waiting to be recorded, and
+            # keep the caches within their bounds, a watch can run for weeks
+            self._flush()
+            if report is not None:
+                report()
+            # Without pending changes, still wake up every so often for the deferred blocks
+            timeout = min((self._settle - (now - at) for at in changed.values()), default=self._settle)
+            for root in source_watcher.wait(max(0.0, timeout)):
+                changed[root] = time.monotonic()
+
+    def query(self, f: t.TextIO, output_format: str = 'json', **conditions) -> int:
+        '''Write the ingested files that match conditions (see utils.query.query) to f as they're found, returns how many'''
+        with self._db_lock:
+            return WRITERS[output_format](query(self.db, **conditions), f)
+
+    def log_plan(self, plan: Plan):
+        '''Log how many files a plan would copy or skip, and where the time went'''
+        skips: dict[str, int] = {}
+        for entry in plan.entries:
+            skips[entry['skip'] or 'copy'] = skips.get(entry['skip'] or 'copy', 0) + 1
+        self.logger.info(f'Plan: {", ".join(f"{count} {reason}" for reason, count in sorted(skips.items()))}')
+        for stage, blocks in plan.timings.items():
+            per_block = ', '.join(f'{block} {seconds:.3f}s' for block, seconds in sorted(blocks.items()))
+            self.logger.info(f'{stage}: {sum(blocks.values()):.3f}s ({per_block})')
+
+# Bytes counters, and the histogram of the time spent moving those bytes, for the throughput in the run summary
+THROUGHPUT = {'bytes_copied': 'copy_seconds', 'bytes_written': 'write_seconds', 'bytes_verified': 'verify_seconds'}
 
 def main():
-    config = load_config()
+    parser = argparse.ArgumentParser(description='Ingest media files based on templates')
+    parser.add_argument('--metrics', type=Path, help='Save a JSON summary of the run (counts, bytes, latencies and throughput per ingest block and device)')
+    parser.add_argument('--prometheus', type=Path, help='Write the run metrics to this Prometheus textfile (for the node_exporter textfile collector)')
+    parser.add_argument('--profile', type=Path, help='Profile the run with cProfile and save the stats to this file')
+    subparsers = parser.add_subparsers(dest='command')
+    ingest_parser = subparsers.add_parser('ingest', help='Copy new files from all ingest sources (default)')
+    ingest_parser.add_argument('--plan', type=Path, help='Copy the files of a plan saved by the plan command, instead of scanning')
+    plan_parser = subparsers.add_parser('plan', help='Show where every file would be copied to, without copying anything')
+    plan_parser.add_argument('output', type=Path, nargs='?', default=Path('plan.json'), help='Where to save the plan, as JSON or CSV (.csv) (default: plan.json)')
+    subparsers.add_parser('verify', help='Re-check every copied file against the digest in the database')
+    watch_parser = subparsers.add_parser('watch', help='Keep running, and ingest new files as soon as a card is mounted or files show up in a source')
+    watch_parser.add_argument('--poll', action='store_true', help='Poll the sources every watch_poll_interval seconds instead of using inotify')
+    query_parser = subparsers.add_parser('query', help='Find ingested files in the database, by source or destination path, digest or when they were ingested')
+    query_parser.add_argument('--source', metavar='PREFIX', help='Files whose source path starts with this')
+    query_parser.add_argument('--destination', metavar='PREFIX', help='Files whose destination path starts with this')
+    query_parser.add_argument('--hash', metavar='HEX', type=bytes.fromhex, help='Files with this digest')
+    query_parser.add_argument('--missing-hash', action='store_true', help='Files without a digest')
+    query_parser.add_argument('--since', metavar='DATE', type=datetime.datetime.fromisoformat, help='Files ingested at or after this (ISO 8601) local time')
+    query_parser.add_argument('--before', metavar='DATE', type=datetime.datetime.fromisoformat, help='Files ingested before this (ISO 8601) local time')
+    query_parser.add_argument('--limit', type=int, help='At most this many files')
+    query_parser.add_argument('--format', choices=sorted(WRITERS), help='Output format (default: from the output\'s extension, or json)')
+    query_parser.add_argument('output', type=Path, nargs='?', help='Where to write the files, as JSON or CSV (.csv) (default: standard output)')
+    args = parser.parse_args()
+
+    config_cache = ConfigCache(Path(CONFIG_FILE))
+    config = load_config(config_cache)
     db = load_db()
 
     ingest_tool = IngestTool(config, db)
-    ingest_tool.ingest()
+    # With the templates IngestTool compiled, so the next run doesn't have to
+    config_cache.save(config)
+    try:
+        with profile(args.profile) if args.profile else nullcontext():
+            ok = run_command(args, ingest_tool)
+    finally:
+        # Also written when the run fails, that's when they're most interesting
+        if args.metrics:
+            ingest_tool.metrics.save_json(args.metrics, THROUGHPUT)
+        if args.prometheus:
+            ingest_tool.metrics.write_prometheus(args.prometheus)
+    if not ok:
+        sys.exit(1)
+
+def run_command(args: argparse.Namespace, ingest_tool: IngestTool) -> bool:
+    '''Run the command given on the command line, returns False if it failed'''
+    if args.command == 'verify':
+        return ingest_tool.verify()
+    elif args.command == 'query':
+        output_format = args.format or ('csv' if args.output and args.output.suffix.lower() == '.csv' else 'json')
+        conditions = dict(source=args.source, destination=args.destination, digest=args.hash, missing_digest=args.missing_hash, since=args.since, before=args.before, limit=args.limit)
+        if args.output is None:
+            ingest_tool.query(sys.stdout, output_format, **conditions)
+        else:
+            with open(args.output, 'w', newline='') as f:
+                count = ingest_tool.query(f, output_format, **conditions)
+            ingest_tool.logger.info(f'{count} files written to {args.output}')
+    elif args.command == 'watch':
+        # The textfile is kept current, a daemon's metrics are no use only once it stops
+        report = (lambda: ingest_tool.metrics.write_prometheus(args.prometheus)) if args.prometheus else None
+        ingest_tool.watch(poll=args.poll, report=report)
+    elif args.command == 'plan':
+        plan = ingest_tool.plan()
+        plan.save(args.output)
+        ingest_tool.log_plan(plan)
+        ingest_tool.logger.info(f'Plan saved to {args.output}')
+    elif getattr(args, 'plan', None) is not None:
+        ingest_tool.run_plan(Plan.load(args.plan))
+    else:
+        ingest_tool.ingest()
+    return True
 
 if __name__ == '__main__':
     logger_needs_redirect = sys.stdout.isatty()
@@ -239,5 +1331,7 @@ if __name__ == '__main__':
     logging.basicConfig(stream=sys.stdout, level=logging.WARNING, format='%(asctime)s %(levelname)-7s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
     logging.getLogger("sh").setLevel(logging.ERROR)
     logging.getLogger("ingest").setLevel(logging.DEBUG)
+    if logger_needs_redirect:
+        from tqdm.contrib.logging import logging_redirect_tqdm
     with logging_redirect_tqdm() if logger_needs_redirect else nullcontext():
         main()
\ No newline at end of file
@@ -0,0 +1,32 @@
+import main
+from utils.db import INGEST_BLOCK_NAME, find_existing
+
+
+def _db(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'DB_FILE', str(tmp_path / 'ingest.db'))
+    return main.load_db()
+
+
+def _insert(db, source, destination, destinations=None):
+    db.execute(
+        'INSERT INTO files (ingest_block_name, source, destination, size, mtime, destinations) VALUES (?, ?, ?, ?, ?, ?)',
+        (INGEST_BLOCK_NAME, source, destination, 5, 10, destinations),
+    )
+
+
+def test_find_existing_needs_every_destination(tmp_path, monkeypatch):
+    db = _db(tmp_path, monkeypatch)
+    _insert(db, '/src/q.bin', '/out/x_q.bin')
+    candidate = (INGEST_BLOCK_NAME, '/src/q.bin', 5, 10, 0.0, 2)
+    assert find_existing(db, [candidate]) == set()
+    _insert(db, '/src/q.bin', '/out/y_q.bin')
+    assert find_existing(db, [candidate]) == {(INGEST_BLOCK_NAME, '/src/q.bin')}
+
+
+def test_find_existing_counts_destinations_recorded_as_one_archived_file(tmp_path, monkeypatch):
+    # Both destinations of q.bin were recorded as the already archived p.bin, which is a single row
+    db = _db(tmp_path, monkeypatch)
+    _insert(db, '/src/p.bin', '/archive/p.bin')
+    _insert(db, '/src/q.bin', '/archive/p.bin', destinations=2)
+    candidates = [(INGEST_BLOCK_NAME, '/src/q.bin', 5, 10, 0.0, 2), (INGEST_BLOCK_NAME, '/src/p.bin', 5, 10, 0.0, 1)]
+    assert find_existing(db, candidates) == {(INGEST_BLOCK_NAME, '/src/q.bin'), (INGEST_BLOCK_NAME, '/src/p.bin')}
@@ -1,9 +1,12 @@
-from tqdm import tqdm
-from functools import partial
-
-
 simple_bar_format="{desc:<35} {percentage:3.0f}%|{bar}| {n_fmt}/{total_fmt}"
 bar_format="{desc:<35} {percentage:3.0f}%|{bar}{r_bar}"
 
-bytes_bar = partial(tqdm, bar_format=bar_format, unit='B', unit_scale=True, unit_divisor=1024)
-simple_bar = partial(tqdm, bar_format=simple_bar_format)
\ No newline at end of file
+# tqdm is imported when the first bar is made, commands without bars don't pay for it
+
+def bytes_bar(**kwargs):
+    from tqdm import tqdm
+    return tqdm(bar_format=bar_format, unit='B', unit_scale=True, unit_divisor=1024, **kwargs)
+
+def simple_bar(**kwargs):
+    from tqdm import tqdm
+    return tqdm(bar_format=simple_bar_format, **kwargs)
\ No newline at end of file
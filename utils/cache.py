@@ -0,0 +1,80 @@
+import sqlite3
+import threading
+import time
+import typing as t
+
+from utils.db import BatchWriter
+from utils.metrics import Metrics
+
+
+class MetadataCache:
+    """Parsed metadata (exif tags, ffprobe output, ...) stored in the db, keyed by the file's path, size and mtime.
+
+    Values are bytes, so each kind of metadata picks its own serialization. Once the cache holds more
+    than max_bytes, the least recently used entries are evicted on flush(). flush() is cheap when
+    nothing was added since the last one, so it can be called often.
+    """
+
+    def __init__(self, db: sqlite3.Connection, lock: threading.Lock, max_bytes: int, flush_rows: int = 500, flush_seconds: float = 5.0, metrics: Metrics = None):
+        self.db = db
+        self.lock = lock
+        self.max_bytes = max_bytes
+        self.metrics = metrics
+        with self.lock:
+            self.db.execute('CREATE TABLE IF NOT EXISTS metadata_cache (path TEXT NOT NULL, size INTEGER NOT NULL, mtime INTEGER NOT NULL, kind TEXT NOT NULL, data BLOB NOT NULL, last_used REAL NOT NULL, PRIMARY KEY(path, size, mtime, kind))')
+            self.db.execute('CREATE INDEX IF NOT EXISTS metadata_cache_last_used ON metadata_cache (last_used)')
+        self._puts = BatchWriter(db, 'INSERT OR REPLACE INTO metadata_cache (path, size, mtime, kind, data, last_used) VALUES (?, ?, ?, ?, ?, ?)', flush_rows, flush_seconds, lock)
+        self._touches = BatchWriter(db, 'UPDATE metadata_cache SET last_used = ? WHERE path = ? AND size = ? AND mtime = ? AND kind = ?', flush_rows, flush_seconds, lock)
+        # Whether the cache may be over max_bytes, set by put() (and at first, max_bytes may have shrunk)
+        self._evict = True
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, path: str, size: int, mtime: int, kind: str) -> t.Optional[bytes]:
+        if not self.enabled:
+            return None
+        with self.lock:
+            row = self.db.execute('SELECT data FROM metadata_cache WHERE path = ? AND size = ? AND mtime = ? AND kind = ?', (path, size, mtime, kind)).fetchone()
+        if row is None:
+            return None
+        self._touches.add((time.time(), path, size, mtime, kind))
+        return row[0]
+
+    def put(self, path: str, size: int, mtime: int, kind: str, data: bytes):
+        if self.enabled:
+            self._evict = True
+            self._puts.add((path, size, mtime, kind, data, time.time()))
+
+    def cached(self, path: str, size: int, mtime: int, kind: str, load: t.Callable[[], t.Any], dumps: t.Callable[[t.Any], t.Optional[bytes]], loads: t.Callable[[bytes], t.Any]):
+        """Get a value from the cache, or load() it and store it (unless dumps returns None)"""
+        data = self.get(path, size, mtime, kind)
+        if self.metrics is not None:
+            # Narrowed ffprobe kinds have their entries after a colon
+            self.metrics.count('metadata_cache_hits' if data is not None else 'metadata_cache_misses', kind=kind.split(':')[0])
+        if data is not None:
+            return loads(data)
+        value = load()
+        data = dumps(value)
+        if data is not None:
+            self.put(path, size, mtime, kind, data)
+        return value
+
+    def flush(self):
+        """Write pending entries and evict the least recently used ones over max_bytes"""
+        self._puts.flush()
+        self._touches.flush()
+        if not self.enabled or not self._evict:
+            return
+        self._evict = False
+        with self.lock:
+            with self.db:
+                self.db.execute('BEGIN')
+                self.db.execute('''
+                    DELETE FROM metadata_cache WHERE rowid IN (
+                        SELECT rowid FROM (
+                            SELECT rowid, SUM(length(data)) OVER (ORDER BY last_used DESC, rowid DESC) AS total FROM metadata_cache
+                        ) WHERE total > ?
+                    )
+                ''', (self.max_bytes,))
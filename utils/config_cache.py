@@ -0,0 +1,72 @@
+import logging
+import marshal
+import os
+from pathlib import Path
+import sys
+import typing as t
+
+from utils import template
+
+# Bumped whenever what is cached (or how templates are parsed) changes
+CACHE_VERSION = 1
+
+logger = logging.getLogger('ingest')
+
+
+def cache_path(config_path: Path) -> Path:
+    """Where the cache of a config file is kept, next to it"""
+    return config_path.with_name(f'.{config_path.name}.cache')
+
+
+def _key(config_path: Path) -> tuple:
+    # Code objects can only be loaded by the Python version that marshaled them
+    st = os.stat(config_path)
+    return (str(config_path.resolve()), st.st_mtime_ns, st.st_size, sys.implementation.cache_tag, CACHE_VERSION)
+
+
+class ConfigCache:
+    """The parsed config and the compiled templates of a config file, marshaled to disk.
+
+    Loading an unchanged config from it skips parsing the toml (and importing tomlkit), and lexing
+    and parsing every template. Any change to the config file (its mtime or size) invalidates it.
+    """
+
+    def __init__(self, config_path: Path):
+        self.config_path = config_path
+        self.path = cache_path(config_path)
+        self._key = _key(config_path)
+        # Templates that were in the cache, it's only written again if more were compiled
+        self._templates: set[str] = set()
+
+    def load(self) -> t.Optional[dict]:
+        """The cached config, None if there's none for the config file as it is now"""
+        try:
+            key, config, templates = marshal.loads(self.path.read_bytes())
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        if key != self._key:
+            return None
+        template.load_compiled(templates)
+        self._templates = set(templates)
+        return config
+
+    def save(self, config: dict):
+        """Cache config, and all templates compiled so far, if that's more than what's cached"""
+        templates = template.compiled()
+        if set(templates) <= self._templates:
+            return
+        try:
+            data = marshal.dumps((self._key, config, templates))
+        except ValueError as e:
+            # Values marshal can't store, like toml dates
+            logger.debug(f'Can\'t cache {self.config_path}: {e}')
+            return
+        part = self.path.with_name(f'{self.path.name}.{os.getpid()}')
+        try:
+            part.write_bytes(data)
+            os.replace(part, self.path)
+        except OSError as e:
+            logger.debug(f'Can\'t write {self.path}: {e}')
+            part.unlink(missing_ok=True)
+            return
+        self._templates = set(templates)
@@ -0,0 +1,115 @@
+import hashlib
+import mmap
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import typing as t
+
+from utils.db import BatchWriter
+from utils.hashing import hash_file
+
+# Bytes hashed from the start and from the end of a file for its partial hash
+PARTIAL_SIZE = 64 * 1024
+
+
+def partial_hash(buf: t.Union[bytes, mmap.mmap], size: int) -> bytes:
+    """Hash of a file's size and its first and last PARTIAL_SIZE bytes, cheap to get even for big files.
+
+    Equal partial hashes only mean files may be the same, unless they are small enough for it to
+    cover all of them.
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(size.to_bytes(8, 'little'))
+    hasher.update(buf[:PARTIAL_SIZE])
+    if size > PARTIAL_SIZE:
+        hasher.update(buf[max(PARTIAL_SIZE, size - PARTIAL_SIZE):size])
+    return hasher.digest()
+
+
+class ContentIndex:
+    """The files written to the destinations, by content, so a file that is already archived (from another source) can be found.
+
+    Files are looked up by size and partial hash, and only when that matches are the full digests
+    compared. Digests of archived files are computed (and stored) the first time they're needed,
+    if the copy didn't already hash them with the index's algorithm.
+    """
+
+    def __init__(self, db: sqlite3.Connection, lock: threading.Lock, algorithm: str, flush_rows: int = 500, flush_seconds: float = 5.0):
+        self.db = db
+        self.lock = lock
+        self.algorithm = algorithm
+        with self.lock:
+            self.db.execute('CREATE TABLE IF NOT EXISTS content_index (path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime INTEGER NOT NULL, partial BLOB NOT NULL, digest BLOB, hash_algorithm TEXT)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS content_index_partial ON content_index (size, partial)')
+        self.writer = BatchWriter(
+            self.db,
+            'INSERT OR REPLACE INTO content_index (path, size, mtime, partial, digest, hash_algorithm) VALUES (?, ?, ?, ?, ?, ?)',
+            max_rows=flush_rows,
+            max_seconds=flush_seconds,
+            lock=lock,
+        )
+        # (size, partial) of the rows that may not be flushed yet
+        self._pending: set[tuple[int, bytes]] = set()
+        self._pending_lock = threading.Lock()
+        # path -> temporary name of the files that aren't renamed to their path yet
+        self._parts: dict[str, Path] = {}
+
+    def add(self, path: Path, size: int, partial: bytes, digest: t.Optional[bytes], part: Path = None):
+        """Record a file written to a destination, digest is of self.algorithm (None if it wasn't hashed with it).
+
+        part is where the file still is if it's only renamed to path later, call renamed() once it is.
+        """
+        with self._pending_lock:
+            self._pending.add((size, partial))
+            if part is not None:
+                self._parts[str(path)] = part
+        self.writer.add((str(path), size, os.stat(part or path).st_mtime_ns, partial, digest, self.algorithm if digest is not None else None))
+
+    def renamed(self, path: Path):
+        with self._pending_lock:
+            self._parts.pop(str(path), None)
+
+    def renaming(self, path: Path) -> bool:
+        """Whether the file at path is still at its temporary name"""
+        with self._pending_lock:
+            return str(path) in self._parts
+
+    def flush(self):
+        with self._pending_lock:
+            self._pending.clear()
+        self.writer.flush()
+
+    def find(self, size: int, partial: bytes, device: int, source_digest: t.Callable[[], bytes]) -> t.Optional[tuple[Path, bytes]]:
+        """Find an archived file on device with the same content, returns its path and digest.
+
+        source_digest is only called if a file with the same size and partial hash is found.
+        """
+        with self._pending_lock:
+            pending = (size, partial) in self._pending
+        if pending:
+            self.flush()
+        with self.lock:
+            rows = self.db.execute('SELECT path, mtime, digest, hash_algorithm FROM content_index WHERE size = ? AND partial = ?', (size, partial)).fetchall()
+
+        for path, mtime, digest, algorithm in rows:
+            with self._pending_lock:
+                location = self._parts.get(path, path)
+            try:
+                st = os.stat(location)
+            except FileNotFoundError:
+                st = None
+            if st is None or st.st_size != size:
+                # Gone, or replaced by something else
+                with self.lock:
+                    self.db.execute('DELETE FROM content_index WHERE path = ?', (path,))
+                continue
+            if st.st_dev != device:
+                continue
+            if digest is None or algorithm != self.algorithm or st.st_mtime_ns != mtime:
+                digest = hash_file(location, self.algorithm, drop_cache=False)
+                with self.lock:
+                    self.db.execute('UPDATE content_index SET mtime = ?, digest = ?, hash_algorithm = ? WHERE path = ?', (st.st_mtime_ns, digest, self.algorithm, path))
+            if digest == source_digest():
+                return Path(path), digest
+        return None
@@ -1,11 +1,24 @@
 from pathlib import Path
 import typing as t
+import errno
+import fcntl
+import mmap
 import os
 import shutil
-from sh import touch
+import threading
 
 BUFFER_SIZE = 4096 * 1024
 
+# ioctl to clone a whole file on filesystems that support reflinks (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+DEFAULT_BACKENDS = ('copy_file_range', 'reflink', 'sendfile', 'readinto')
+
+# errnos that mean "this backend can't do this pair of files", rather than an actual io error
+UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL, errno.ENOTTY, errno.EBADF}
+
+Callback = t.Callable[[int, int, int], None]
+
 
 class SameFileError(OSError):
     """Raised when source and destination are the same file."""
@@ -64,8 +77,8 @@ def copy_with_callback(
             try:
                 with open(srcfile, "rb") as fsrc:
                     with open(destfile, "wb") as fdest:
-                        _copyfileobj(
-                            fsrc, fdest, callback=callback, total=size, length=buffer_size
+                        transfer(
+                            fsrc.fileno(), fdest.fileno(), size, callback=callback, chunk_size=buffer_size
                         )
                 break
             except PermissionError:
@@ -75,25 +88,256 @@ def copy_with_callback(
                     continue
 
     shutil.copymode(str(srcfile), str(destfile))
+    # Imported here, sh is slow to import and nothing else needs it
+    from sh import touch
     touch("-d", f'@{stat.st_ctime}', str(destfile))
     return str(destfile)
 
 
-def _copyfileobj(fsrc, fdest, callback, total, length):
-    """ copy from fsrc to fdest
-    Args:
-        fsrc: filehandle to source file
-        fdest: filehandle to destination file
-        callback: callable callback that will be called after every length bytes copied
-        total: total bytes in source file (will be passed to callback)
-        length: how many bytes to copy at once (between calls to callback)
-    """
-    copied = 0
+class UnsupportedTransfer(OSError):
+    """Raised by a transfer backend when it can't copy between the given files.
+    Nothing has been written when this is raised, so the next backend can take over."""
+
+
+def _copy_file_range(src_fd: int, dst_fd: int, offset: int, total: int, callback: Callback, chunk_size: int, hasher=None) -> int:
+    copied = offset
     while True:
-        buf = fsrc.read(length)
-        if not buf:
-            break
-        fdest.write(buf)
-        copied += len(buf)
+        try:
+            n = os.copy_file_range(src_fd, dst_fd, chunk_size, copied, copied)
+        except OSError as e:
+            if copied == offset and e.errno in UNSUPPORTED_ERRNOS:
+                raise UnsupportedTransfer(e.errno, e.strerror) from e
+            raise
+        if n == 0:
+            return copied
+        copied += n
         if callback is not None:
-            callback(len(buf), copied, total)
\ No newline at end of file
+            callback(n, copied, total)
+
+
+def _reflink(src_fd: int, dst_fd: int, offset: int, total: int, callback: Callback, chunk_size: int, hasher=None) -> int:
+    if offset != 0 or os.fstat(src_fd).st_dev != os.fstat(dst_fd).st_dev:
+        raise UnsupportedTransfer(errno.EXDEV, 'reflink needs both files on the same filesystem')
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except OSError as e:
+        if e.errno in UNSUPPORTED_ERRNOS:
+            raise UnsupportedTransfer(e.errno, e.strerror) from e
+        raise
+    size = os.fstat(dst_fd).st_size
+    if callback is not None:
+        callback(size, size, total)
+    return size
+
+
+def _sendfile(src_fd: int, dst_fd: int, offset: int, total: int, callback: Callback, chunk_size: int, hasher=None) -> int:
+    copied = offset
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    while True:
+        try:
+            n = os.sendfile(dst_fd, src_fd, copied, chunk_size)
+        except OSError as e:
+            if copied == offset and e.errno in UNSUPPORTED_ERRNOS:
+                raise UnsupportedTransfer(e.errno, e.strerror) from e
+            raise
+        if n == 0:
+            return copied
+        copied += n
+        if callback is not None:
+            callback(n, copied, total)
+
+
+def _readinto(src_fd: int, dst_fd: int, offset: int, total: int, callback: Callback, chunk_size: int, hasher=None) -> int:
+    copied = offset
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    with open(src_fd, 'rb', buffering=0, closefd=False) as fsrc, open(dst_fd, 'wb', buffering=0, closefd=False) as fdest:
+        fsrc.seek(offset)
+        fdest.seek(offset)
+        while True:
+            n = fsrc.readinto(buf)
+            if not n:
+                return copied
+            written = 0
+            while written < n:
+                written += fdest.write(view[written:n])
+            if hasher is not None:
+                hasher.update(view[:n])
+            copied += n
+            if callback is not None:
+                callback(n, copied, total)
+
+
+BACKENDS: dict[str, t.Callable[..., int]] = {
+    'copy_file_range': _copy_file_range,
+    'reflink': _reflink,
+    'sendfile': _sendfile,
+    'readinto': _readinto,
+}
+
+# Backends that see the copied bytes, and can hash them themselves
+USERSPACE_BACKENDS = {'readinto'}
+
+if not hasattr(os, 'copy_file_range'):
+    del BACKENDS['copy_file_range']
+if not hasattr(os, 'sendfile'):
+    del BACKENDS['sendfile']
+
+# (backend, src dev, dst dev) that have failed before, so we don't retry a failing syscall for every file
+_unsupported: set[tuple[str, int, int]] = set()
+
+
+def transfer(
+    src_fd: int,
+    dst_fd: int,
+    total: int,
+    callback: Callback = None,
+    backends: t.Iterable[str] = DEFAULT_BACKENDS,
+    chunk_size: int = BUFFER_SIZE,
+    offset: int = 0,
+    hasher=None,
+) -> str:
+    """Copy src_fd to dst_fd (from offset until EOF), using the first backend that works.
+
+    callback is called with (bytes copied now, bytes copied in total, total) after every chunk_size bytes.
+    If a hasher is given it's updated with every copied byte. Kernel-side backends hash each chunk from
+    a mmap of the source right after copying it, while it's still in the page cache, so the source is
+    only read from the device once.
+    A backend that stops short of total (copy_file_range and sendfile can return 0 early on some
+    FUSE, overlay and network filesystems) is not used for those devices again, and the next one
+    carries on from where it stopped. OSError is raised if the copy still isn't total bytes.
+    Returns the name of the backend that finished the copy.
+    """
+    src_stat = os.fstat(src_fd)
+    devs = (src_stat.st_dev, os.fstat(dst_fd).st_dev)
+    src_mem = mmap.mmap(src_fd, 0, access=mmap.ACCESS_READ) if hasher is not None and src_stat.st_size > 0 else None
+    short = False
+    try:
+        for name in backends:
+            if name not in BACKENDS or (name, *devs) in _unsupported:
+                continue
+
+            backend_callback = callback
+            if src_mem is not None and name not in USERSPACE_BACKENDS:
+                def backend_callback(n: int, copied: int, total: int):
+                    with memoryview(src_mem) as view:
+                        hasher.update(view[copied - n:copied])
+                    if callback is not None:
+                        callback(n, copied, total)
+
+            try:
+                copied = BACKENDS[name](src_fd, dst_fd, offset, total, backend_callback, chunk_size, hasher=hasher)
+            except UnsupportedTransfer:
+                # Some backends (reflink) only can't do resumed copies, that says nothing about the devices
+                if offset == 0:
+                    _unsupported.add((name, *devs))
+                continue
+            if copied == total:
+                return name
+            if copied > total:
+                raise OSError(errno.EIO, f'Copied {copied} bytes, expected {total} (the source grew while it was copied)')
+            # The hasher and callback have seen exactly the bytes up to copied, the next backend takes over from there
+            _unsupported.add((name, *devs))
+            offset = copied
+            short = True
+    finally:
+        if src_mem is not None:
+            src_mem.close()
+    if short:
+        raise OSError(errno.EIO, f'Short copy: {offset} of {total} bytes (tried {", ".join(backends)})')
+    raise UnsupportedTransfer(errno.ENOTSUP, f'No transfer backend could copy the file (tried {", ".join(backends)})')
+
+
+def tee(
+    src_fd: int,
+    dst_fds: t.Sequence[int],
+    total: int,
+    callback: Callback = None,
+    chunk_size: int = BUFFER_SIZE,
+    buffers: int = 8,
+    hasher=None,
+    offset: int = 0,
+) -> list[t.Optional[BaseException]]:
+    """Copy src_fd to every one of dst_fds (from offset until EOF), reading each byte of the source only once.
+
+    Chunks are read into a ring of `buffers` shared buffers and every destination is written by its
+    own thread, so a slow destination only holds the others back once it's a whole ring behind.
+    callback and hasher see the source bytes once, as they are read.
+    Returns the error of each destination (None if it was written fine). A failing destination
+    doesn't stop the others.
+    """
+    # No bigger ring than the file needs, small files are the common case
+    chunk_size = max(1, min(chunk_size, total - offset))
+    buffers = max(1, min(buffers, -(-(total - offset) // chunk_size)))
+    ring = [bytearray(chunk_size) for _ in range(buffers)]
+    lengths = [0] * buffers
+    cond = threading.Condition()
+    # Chunks read from the source, and chunks written by each destination (inf once it failed)
+    produced = 0
+    consumed: list[float] = [0] * len(dst_fds)
+    finished = False
+    errors: list[t.Optional[BaseException]] = [None] * len(dst_fds)
+
+    def writer(i: int, fd: int):
+        seq = 0
+        try:
+            while True:
+                with cond:
+                    while seq >= produced and not finished:
+                        cond.wait()
+                    if seq >= produced:
+                        return
+                    slot, n = seq % buffers, lengths[seq % buffers]
+                with memoryview(ring[slot]) as view:
+                    written = 0
+                    while written < n:
+                        written += os.write(fd, view[written:n])
+                seq += 1
+                with cond:
+                    consumed[i] = seq
+                    cond.notify_all()
+        except BaseException as e:
+            errors[i] = e
+            with cond:
+                consumed[i] = float('inf')
+                cond.notify_all()
+
+    for fd in dst_fds:
+        os.lseek(fd, offset, os.SEEK_SET)
+    threads = [threading.Thread(target=writer, args=(i, fd), name=f'tee-{i}', daemon=True) for i, fd in enumerate(dst_fds)]
+    for thread in threads:
+        thread.start()
+
+    copied = offset
+    try:
+        with open(src_fd, 'rb', buffering=0, closefd=False) as fsrc:
+            fsrc.seek(offset)
+            while not all(errors):
+                with cond:
+                    # Wait until every destination is done with the buffer we're about to reuse
+                    while produced - min(consumed) >= buffers:
+                        cond.wait()
+                slot = produced % buffers
+                n = fsrc.readinto(ring[slot])
+                if not n:
+                    break
+                if hasher is not None:
+                    with memoryview(ring[slot]) as view:
+                        hasher.update(view[:n])
+                with cond:
+                    lengths[slot] = n
+                    produced += 1
+                    cond.notify_all()
+                copied += n
+                if callback is not None:
+                    callback(n, copied, total)
+    finally:
+        with cond:
+            finished = True
+            cond.notify_all()
+        for thread in threads:
+            thread.join()
+
+    if copied != total and not all(errors):
+        raise OSError(errno.EIO, f'Read {copied} of {total} bytes of the source')
+    return errors
@@ -0,0 +1,74 @@
+import datetime
+import sqlite3
+import threading
+import time
+import typing as t
+
+# ingest_block_name of every row in the files table. It has always been the name of the toml table
+# the blocks are in ([[ingest]]) rather than the block's own name, and existing rows are matched on it
+INGEST_BLOCK_NAME = 'ingest'
+
+
+def legacy_mtime(st_mtime: float) -> str:
+    """How mtime used to be stored, as the sqlite3 adapted naive local datetime"""
+    return str(datetime.datetime.fromtimestamp(st_mtime))
+
+
+def find_existing(db: sqlite3.Connection, candidates: t.Iterable[tuple[str, str, int, int, float, int]]) -> set[tuple[str, str]]:
+    """Find which candidates are already in the files table, with a single join.
+
+    candidates are (ingest_block_name, source, size, st_mtime_ns, st_mtime, destinations) tuples.
+    Returns (ingest_block_name, source) of the ones that have rows for at least that many destinations
+    (a row recorded for several destinations counts for all of them).
+    Rows written before mtime was stored as integer nanoseconds are matched on their old datetime string.
+    """
+    db.execute('CREATE TEMP TABLE IF NOT EXISTS candidates (ingest_block_name TEXT NOT NULL, source TEXT NOT NULL, size INTEGER NOT NULL, mtime INTEGER NOT NULL, legacy_mtime TEXT NOT NULL, destinations INTEGER NOT NULL)')
+    db.executemany('INSERT INTO temp.candidates VALUES (?, ?, ?, ?, ?, ?)', (
+        (block, source, size, mtime_ns, legacy_mtime(st_mtime), destinations) for block, source, size, mtime_ns, st_mtime, destinations in candidates
+    ))
+    rows = db.execute('''
+        SELECT c.ingest_block_name, c.source FROM temp.candidates c
+        WHERE (
+            SELECT TOTAL(COALESCE(f.destinations, 1)) FROM files f
+            WHERE f.ingest_block_name = c.ingest_block_name AND f.source = c.source AND f.size = c.size
+            AND (f.mtime = c.mtime OR f.mtime = c.legacy_mtime)
+        ) >= c.destinations
+    ''').fetchall()
+    db.execute('DELETE FROM temp.candidates')
+    return set(rows)
+
+
+class BatchWriter:
+    """Groups inserts into transactions instead of autocommitting every row.
+
+    Rows are flushed once max_rows are pending or max_seconds have passed since the last flush,
+    and on flush(). Safe to call from multiple threads.
+    """
+
+    def __init__(self, db: sqlite3.Connection, sql: str, max_rows: int, max_seconds: float, lock: threading.Lock = None):
+        self.db = db
+        self.sql = sql
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.lock = lock or threading.Lock()
+        self._rows: list[tuple] = []
+        self._last_flush = time.monotonic()
+
+    def add(self, row: tuple):
+        with self.lock:
+            self._rows.append(row)
+            if len(self._rows) >= self.max_rows or time.monotonic() - self._last_flush >= self.max_seconds:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        self._last_flush = time.monotonic()
+        if not self._rows:
+            return
+        with self.db:
+            self.db.execute('BEGIN')
+            self.db.executemany(self.sql, self._rows)
+        self._rows = []
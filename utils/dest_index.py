@@ -0,0 +1,112 @@
+from collections import OrderedDict
+import os
+from pathlib import Path
+import threading
+import typing as t
+
+from utils.path import device_of
+
+# Size recorded for entries that aren't regular files (directories, ...)
+NOT_A_FILE = -1
+
+
+def counter_names(path: Path) -> t.Iterator[Path]:
+    """path, then the same name with a counter added: IMG_0001.jpg, IMG_0001_1.jpg, IMG_0001_2.jpg, ..."""
+    yield path
+    i = 1
+    while True:
+        yield path.with_name(f'{path.stem}_{i}{path.suffix}')
+        i += 1
+
+
+class DestinationIndex:
+    """What is in the destination directories, listed once per directory and kept up to date as files are written.
+
+    Replaces an exists()/stat() per file, and a mkdir() per file, with a scandir per directory,
+    which matters when the destination is a network share where each of those is a round trip.
+    Only files written through it are seen, so it should live for one run. At most max_directories
+    listings are kept, the least recently used one is dropped (and listed again if it's needed).
+    """
+
+    def __init__(self, max_directories: int = 4096):
+        self._lock = threading.Lock()
+        self.max_directories = max_directories
+        # Directory -> {name: size, or None until it's needed}, None for a directory that doesn't exist
+        self._listings: OrderedDict[Path, t.Optional[dict[str, t.Optional[int]]]] = OrderedDict()
+        # Directories that were made (or already existed)
+        self._made: set[Path] = set()
+        # Directory -> st_dev of the filesystem it's on
+        self._devices: dict[Path, int] = {}
+
+    def _listing(self, directory: Path) -> t.Optional[dict[str, t.Optional[int]]]:
+        with self._lock:
+            if directory in self._listings:
+                self._listings.move_to_end(directory)
+                return self._listings[directory]
+        # Listed without holding the lock, a slow directory shouldn't block lookups in the others
+        try:
+            with os.scandir(directory) as it:
+                # Sizes are only looked up for the names that are asked for, most never are
+                listing = {entry.name: None if entry.is_file() else NOT_A_FILE for entry in it}
+        except (FileNotFoundError, NotADirectoryError):
+            listing = None
+        with self._lock:
+            listing = self._listings.setdefault(directory, listing)
+            while len(self._listings) > self.max_directories:
+                self._listings.popitem(last=False)
+            return listing
+
+    def load(self, directory: Path):
+        """List a directory now, if it wasn't yet"""
+        self._listing(directory)
+
+    def size(self, path: Path) -> t.Optional[int]:
+        """Size of the file at path, None if nothing is there (NOT_A_FILE if it's not a file)"""
+        listing = self._listing(path.parent)
+        if listing is None or path.name not in listing:
+            return None
+        size = listing[path.name]
+        if size is None:
+            try:
+                size = os.stat(path).st_size
+            except FileNotFoundError:
+                # Removed since it was listed
+                with self._lock:
+                    listing.pop(path.name, None)
+                return None
+            with self._lock:
+                listing[path.name] = size
+        return size
+
+    def add(self, path: Path, size: int):
+        """Record a file that was written"""
+        with self._lock:
+            # A directory that wasn't listed yet will be listed with it
+            if path.parent in self._listings:
+                if self._listings[path.parent] is None:
+                    self._listings[path.parent] = {}
+                self._listings[path.parent][path.name] = size
+
+    def makedirs(self, directory: Path):
+        """Make a directory and its parents, once per directory"""
+        with self._lock:
+            if directory in self._made:
+                return
+        directory.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            self._made.add(directory)
+            # Directories that didn't exist when they were listed are empty now
+            for d in (directory, *directory.parents):
+                if d in self._listings and self._listings[d] is None:
+                    self._listings[d] = {}
+
+    def device(self, path: Path) -> int:
+        """st_dev of the filesystem path is (or will be) written to, looked up once per directory"""
+        with self._lock:
+            if path.parent in self._devices:
+                return self._devices[path.parent]
+        # Until it's made, a directory is on the device of its closest existing parent
+        device = device_of(path.parent)
+        with self._lock:
+            self._devices[path.parent] = device
+        return device
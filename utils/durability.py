@@ -0,0 +1,154 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+from pathlib import Path
+import threading
+import time
+import typing as t
+
+# How the files written to a destination are made durable before their rows are committed to the db:
+# 'none' leaves it to the OS, 'fsync' syncs every file (and its directory) before it's recorded,
+# 'batch' fsyncs the files in groups, 'syncfs' syncs their whole filesystem once per group
+DURABILITY = ('none', 'fsync', 'batch', 'syncfs')
+
+# fallocate(2)
+FALLOC_FL_KEEP_SIZE = 0x01
+
+logger = logging.getLogger('ingest')
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+if hasattr(_libc, 'fallocate'):
+    _libc.fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+
+
+def preallocate(fd: int, size: int) -> bool:
+    """Reserve size bytes for a file that is about to be written, so it gets few, contiguous extents.
+
+    The file's size doesn't change, a copy that is interrupted looks the same as without it.
+    Returns False where the filesystem can't (or it isn't Linux), which isn't an error.
+    """
+    if size <= 0 or not hasattr(_libc, 'fallocate'):
+        return False
+    if _libc.fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, size) == 0:
+        return True
+    e = ctypes.get_errno()
+    if e in (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL, errno.ENODEV):
+        return False
+    raise OSError(e, os.strerror(e))
+
+
+def sync_directory(directory: Path):
+    """fsync a directory, so the files renamed into it are there after a crash"""
+    fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def syncfs(path: Path) -> bool:
+    """Sync the whole filesystem path is on, returns False where syncfs isn't available"""
+    if not hasattr(_libc, 'syncfs'):
+        return False
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if _libc.syncfs(fd) != 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+    finally:
+        os.close(fd)
+    return True
+
+
+class SyncGroups:
+    """Holds back the db rows of written files until the files are durable, grouped per destination device.
+
+    A group is synced once it has max_files files or max_bytes bytes, once it's max_seconds old when
+    the next file is added, and on flush(). Only then are its rows passed to record. Rows of files
+    that don't need syncing (or were synced already) are passed on right away. Safe to call from
+    multiple threads.
+
+    A file can be added while it's still at its temporary name (part), it's only renamed to path once
+    its data is synced, so a crash can't leave a final name with missing data behind it.
+    """
+
+    def __init__(self, record: t.Callable[[tuple], None], max_files: int, max_bytes: int, max_seconds: float, metrics=None):
+        self.record = record
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        # (device, mode) -> [(path, part, row, done)], bytes in it, when its first file was added
+        self._groups: dict[tuple[int, str], tuple[list[tuple[Path, t.Optional[Path], tuple, t.Optional[t.Callable[[], None]]]], int, float]] = {}
+
+    def add(self, row: tuple, path: Path, size: int, device: int, mode: str, part: Path = None, done: t.Callable[[], None] = None):
+        """Record row once the file at path is durable. If part is given, the file is still there, and
+        is renamed to path first. done is called once it's durable, before row is recorded."""
+        if mode not in ('batch', 'syncfs'):
+            if part is not None:
+                os.replace(part, path)
+            if done is not None:
+                done()
+            self.record(row)
+            return
+        key = (device, mode)
+        with self._lock:
+            files, group_bytes, started = self._groups.get(key, ([], 0, time.monotonic()))
+            files.append((path, part, row, done))
+            group_bytes += size
+            if len(files) < self.max_files and group_bytes < self.max_bytes and time.monotonic() - started < self.max_seconds:
+                self._groups[key] = (files, group_bytes, started)
+                return
+            self._groups.pop(key, None)
+        self._sync(mode, files)
+
+    def flush(self):
+        with self._lock:
+            groups, self._groups = self._groups, {}
+        for (_, mode), (files, _, _) in groups.items():
+            self._sync(mode, files)
+
+    def _sync(self, mode: str, files: list[tuple[Path, t.Optional[Path], tuple, t.Optional[t.Callable[[], None]]]]):
+        start = time.perf_counter()
+        # First the data, where it is now
+        if mode != 'syncfs' or not syncfs(files[0][0].parent):
+            synced = []
+            for entry in files:
+                path, part = entry[0], entry[1]
+                try:
+                    fd = os.open(part or path, os.O_RDONLY)
+                except FileNotFoundError:
+                    # Removed since it was written, there's nothing to record
+                    continue
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                synced.append(entry)
+            files = synced
+
+        # Then the final names
+        renamed = []
+        for entry in files:
+            path, part = entry[0], entry[1]
+            if part is not None:
+                try:
+                    os.replace(part, path)
+                except OSError as e:
+                    logger.error(f'{part} -> {path} failed: {e}. Keeping the partial copy to resume it next time...')
+                    continue
+            renamed.append(entry)
+        files = renamed
+        for directory in {path.parent for path, _, _, _ in files}:
+            sync_directory(directory)
+
+        if self.metrics is not None:
+            self.metrics.observe('sync_seconds', time.perf_counter() - start, mode=mode)
+            self.metrics.count('files_synced', len(files), mode=mode)
+        for _, _, row, done in files:
+            if done is not None:
+                done()
+            self.record(row)
@@ -1,65 +1,263 @@
-import io
+from collections.abc import Mapping
+import functools
 import struct
+import typing as t
 
-import piexif._load
-from piexif._exceptions import InvalidImageDataError
-from piexif import _webp
+from utils import mp4
 
-def read_exif_from_file(f: io.BufferedIOBase):
-    """Slices JPEG meta data into a list from JPEG binary data.
-    """
-    f.seek(0)
-    data = f.read(6)
-
-    if data[0:2] != b"\xff\xd8":
-        raise InvalidImageDataError("Given data isn't JPEG.")
-
-    head = data[2:6]
-    HEAD_LENGTH = 4
-    exif = None
-    while len(head) == HEAD_LENGTH:
-        length = struct.unpack(">H", head[2: 4])[0]
-
-        if head[:2] == b"\xff\xe1":
-            segment_data = f.read(length - 2)
-            if segment_data[:4] != b'Exif':
-                head = f.read(HEAD_LENGTH)
-                continue
-            exif = head + segment_data
+# Size in bytes of each TIFF value type
+TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8}
+# struct format of each numeric TIFF value type
+TYPE_FORMATS = {1: 'B', 3: 'H', 4: 'L', 5: 'L', 6: 'b', 8: 'h', 9: 'l', 10: 'l', 11: 'f', 12: 'd'}
+
+# Byte orders and magic numbers of TIFF and the TIFF based RAW formats (ARW, DNG, NEF, CR2 are plain TIFF)
+TIFF_HEADERS = {
+    b'II*\x00': '<', b'MM\x00*': '>',
+    b'IIRO': '<',  # Olympus ORF
+    b'IIRS': '<',  # Olympus ORF
+    b'IIU\x00': '<',  # Panasonic RW2
+}
+
+HEIF_BRANDS = {b'heic', b'heix', b'heim', b'heis', b'hevc', b'mif1', b'msf1', b'avif'}
+
+# Values bigger than this (MakerNote, UserComment, ...) aren't worth caching
+SMALL_VALUE = 256
+
+
+@functools.cache
+def tags() -> dict[str, dict[int, dict]]:
+    """piexif's tag tables, group -> tag -> {'name': ..., 'type': ...}, imported the first time exif is read"""
+    from piexif import TAGS
+    return TAGS
+
+
+class InvalidImageDataError(ValueError):
+    """Raised when no exif data can be found in the file"""
+
+
+def _jpeg_exif(buf) -> t.Optional[memoryview]:
+    """Find the TIFF data in the APP1 segment of a JPEG, only reading segment headers"""
+    offset = 2
+    end = len(buf)
+    while offset + 4 <= end:
+        marker, length = struct.unpack_from('>2sH', buf, offset)
+        if marker[0:1] != b'\xff' or marker == b'\xff\xda':
             break
-        elif head[0:1] == b"\xff":
-            f.read(length - 2)
-            head = f.read(HEAD_LENGTH)
-        else:
+        if marker == b'\xff\xe1' and buf[offset + 4:offset + 10] == b'Exif\x00\x00':
+            return memoryview(buf)[offset + 10:offset + 2 + length]
+        offset += 2 + length
+    return None
+
+
+def _webp_exif(buf) -> t.Optional[memoryview]:
+    """Find the EXIF chunk of a WEBP, only reading chunk headers"""
+    offset = 12
+    end = len(buf)
+    while offset + 8 <= end:
+        chunk, length = struct.unpack_from('<4sL', buf, offset)
+        if chunk == b'EXIF':
+            data = memoryview(buf)[offset + 8:offset + 8 + length]
+            # Some writers include the JPEG style "Exif\0\0" header
+            return data[6:] if data[:6] == b'Exif\x00\x00' else data
+        offset += 8 + length + (length & 1)
+    return None
+
+
+def _uint(buf, offset: int, size: int) -> int:
+    return int.from_bytes(buf[offset:offset + size], 'big') if size else 0
+
+
+def _heif_exif(buf) -> t.Optional[memoryview]:
+    """Find the Exif item of a HEIF/HEIC through the meta box (iinf for its id, iloc for where it is)"""
+    meta = mp4.find(buf, 0, len(buf), b'meta')
+    if meta is None:
+        return None
+    start, end = meta[0] + 4, meta[1]
+
+    iinf = mp4.find(buf, start, end, b'iinf')
+    iloc = mp4.find(buf, start, end, b'iloc')
+    if iinf is None or iloc is None:
+        return None
+
+    exif_id = None
+    version = buf[iinf[0]]
+    entries_start = iinf[0] + (6 if version == 0 else 8)
+    for box_type, infe_start, infe_end in mp4.boxes(buf, entries_start, iinf[1]):
+        infe_version = buf[infe_start]
+        if box_type != b'infe' or infe_version < 2:
+            continue
+        id_size = 2 if infe_version == 2 else 4
+        item_type = bytes(buf[infe_start + 4 + id_size + 2:infe_start + 4 + id_size + 6])
+        if item_type == b'Exif':
+            exif_id = _uint(buf, infe_start + 4, id_size)
             break
+    if exif_id is None:
+        return None
+
+    offset = iloc[0]
+    version = buf[offset]
+    offset_size, length_size = buf[offset + 4] >> 4, buf[offset + 4] & 0xf
+    base_offset_size, index_size = buf[offset + 5] >> 4, (buf[offset + 5] & 0xf) if version in (1, 2) else 0
+    offset += 6
+    id_size = 2 if version < 2 else 4
+    item_count = _uint(buf, offset, id_size)
+    offset += id_size
+    for _ in range(item_count):
+        item_id = _uint(buf, offset, id_size)
+        offset += id_size
+        if version in (1, 2):
+            offset += 2  # construction_method
+        offset += 2  # data_reference_index
+        base_offset = _uint(buf, offset, base_offset_size)
+        offset += base_offset_size
+        extent_count = _uint(buf, offset, 2)
+        offset += 2
+        extents = []
+        for _ in range(extent_count):
+            offset += index_size
+            extent_offset = _uint(buf, offset, offset_size)
+            extent_length = _uint(buf, offset + offset_size, length_size)
+            offset += offset_size + length_size
+            extents.append((base_offset + extent_offset, extent_length))
+        if item_id == exif_id and extents:
+            item_offset, item_length = extents[0]
+            # The item starts with the offset to the TIFF header, usually past "Exif\0\0"
+            tiff_offset = _uint(buf, item_offset, 4)
+            return memoryview(buf)[item_offset + 4 + tiff_offset:item_offset + item_length]
+    return None
+
+
+def find_tiff(buf) -> memoryview:
+    """Find the TIFF structure with the exif data in a JPEG, TIFF/RAW, WEBP or HEIF file, without copying it"""
+    if buf[0:2] == b'\xff\xd8':
+        tiff = _jpeg_exif(buf)
+    elif bytes(buf[0:4]) in TIFF_HEADERS:
+        tiff = memoryview(buf)
+    elif buf[0:4] == b'RIFF' and buf[8:12] == b'WEBP':
+        tiff = _webp_exif(buf)
+    elif buf[4:8] == b'ftyp' and bytes(buf[8:12]) in HEIF_BRANDS:
+        tiff = _heif_exif(buf)
+    else:
+        raise InvalidImageDataError('Given file is neither JPEG, TIFF, WEBP nor HEIF.')
+    if tiff is None or bytes(tiff[0:4]) not in TIFF_HEADERS:
+        raise InvalidImageDataError('No exif data found.')
+    return tiff
+
+
+class ExifTags(Mapping):
+    """The tags of the 0th and Exif IFDs, by name.
+
+    Only the IFD entry tables are read up front, each value is decoded (and its data read) the
+    first time it's accessed. Tags in the Exif IFD take precedence over 0th tags with the same name.
+    """
+
+    def __init__(self, tiff: memoryview):
+        self.tiff = tiff
+        self.endian = TIFF_HEADERS[bytes(tiff[0:4])]
+        # name -> (type, count, offset of the value field)
+        self._entries: dict[str, tuple[int, int, int]] = {}
+        self._values = {}
+
+        ifd0_offset, = struct.unpack_from(self.endian + 'L', tiff, 4)
+        self._read_ifd(ifd0_offset, 'Image')
+        if 'ExifTag' in self._entries:
+            self._read_ifd(self['ExifTag'], 'Exif')
+
+    def _read_ifd(self, offset: int, group: str):
+        try:
+            count, = struct.unpack_from(self.endian + 'H', self.tiff, offset)
+            group_tags = tags()[group]
+            for i in range(count):
+                entry = offset + 2 + i * 12
+                tag, value_type, value_count = struct.unpack_from(self.endian + 'HHL', self.tiff, entry)
+                if tag in group_tags and value_type in TYPE_SIZES:
+                    self._entries[group_tags[tag]['name']] = (value_type, value_count, entry + 8)
+        except struct.error:
+            # Truncated IFD, keep what we got
+            pass
 
-    return exif
-
-class CustomExifReader(piexif._load._ExifReader):
-    def __init__(self, f: io.BufferedIOBase):
-        f.seek(0)
-        magic_number = f.read(2)
-        
-        if magic_number == b"\xff\xd8":  # JPEG
-            app1 = read_exif_from_file(f)
-            if app1:
-                self.tiftag = app1[10:]
-            else:
-                self.tiftag = None
-        elif magic_number in (b"\x49\x49", b"\x4d\x4d"):  # TIFF
-            f.seek(0)
-            self.tiftag = f.read()
+    def _decode(self, value_type: int, count: int, field: int):
+        tiff, endian = self.tiff, self.endian
+        size = TYPE_SIZES[value_type] * count
+        offset = field if size <= 4 else struct.unpack_from(endian + 'L', tiff, field)[0]
+        if offset + size > len(tiff):
+            raise ValueError('Exif value is outside of the exif data')
+
+        if value_type == 2:  # ASCII, without the trailing NUL
+            return bytes(tiff[offset:offset + max(count - 1, 0)])
+        if value_type == 7:  # UNDEFINED
+            return bytes(tiff[offset:offset + count])
+
+        fmt = TYPE_FORMATS[value_type]
+        if value_type in (5, 10):  # (S)RATIONAL, as (numerator, denominator) pairs
+            values = struct.unpack_from(endian + fmt * (count * 2), tiff, offset)
+            data = tuple(zip(values[0::2], values[1::2]))
         else:
-            f.seek(0)
-            header = f.read(12)
-            if header[0:4] == b"RIFF"and header[8:12] == b"WEBP":
-                f.seek(0)
-                file_data = f.read()
-                self.tiftag = _webp.get_exif(file_data)
-            else:
-                raise InvalidImageDataError("Given file is neither JPEG nor TIFF.")
-
-piexif._load._ExifReader = CustomExifReader
-
-load = piexif._load.load
-TAGS = piexif.TAGS
\ No newline at end of file
+            data = struct.unpack_from(endian + fmt * count, tiff, offset)
+        return data[0] if len(data) == 1 else data
+
+    def __getitem__(self, name: str):
+        if name not in self._values:
+            self._values[name] = self._decode(*self._entries[name])
+        return self._values[name]
+
+    def __contains__(self, name) -> bool:
+        return name in self._entries
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def release(self):
+        """Release the underlying buffer, after this values that weren't accessed yet can't be decoded"""
+        self.tiff.release()
+
+    def small(self, keep: t.Collection[str] = ()) -> dict:
+        """All tags with values small enough to cache, and the ones in keep whatever their size, decoded"""
+        return {name: self[name] for name, (value_type, count, _) in self._entries.items() if TYPE_SIZES[value_type] * count <= SMALL_VALUE or name in keep}
+
+
+def used_tags(chains: t.Iterable[tuple]) -> t.Optional[frozenset[str]]:
+    """The tag names in the subscripts used on the exif tags (see Template.subscripts).
+
+    Returns None if the tags are used in a way that could need any of them (iterated, `in`, ...).
+    """
+    names = set()
+    for chain in chains:
+        if not chain or not isinstance(chain[0], str):
+            return None
+        names.add(chain[0])
+    return frozenset(names)
+
+
+def load(buf) -> ExifTags:
+    """Read the exif tags of an image, buf is anything that supports the buffer protocol (like a mmap)"""
+    return ExifTags(find_tiff(buf))
+
+
+class LazyDict(Mapping):
+    """A mapping with known keys, where each value is computed by load(key) the first time it's accessed"""
+
+    def __init__(self, keys: t.Iterable[str], load: t.Callable[[str], t.Any]):
+        self._keys = list(keys)
+        self._key_set = set(self._keys)
+        self._load = load
+        self._values = {}
+
+    def __getitem__(self, key):
+        if key not in self._key_set:
+            raise KeyError(key)
+        if key not in self._values:
+            self._values[key] = self._load(key)
+        return self._values[key]
+
+    def __contains__(self, key) -> bool:
+        return key in self._key_set
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self) -> int:
+        return len(self._keys)
@@ -0,0 +1,109 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import json
+import os
+import subprocess
+import threading
+import typing as t
+
+from utils.metrics import Metrics
+
+# Sections of the ffprobe output we know how to narrow, and their -show_entries names
+SECTIONS = {'format': ('format', 'format_tags'), 'streams': ('stream', 'stream_tags')}
+
+
+def probe(path: t.Union[os.PathLike, str], entries: str = None) -> dict:
+    """Run ffprobe on a file. With entries, only those are probed (see ffprobe -show_entries)"""
+    if entries is None:
+        show = ['-show_format', '-show_streams', '-show_programs', '-show_chapters', '-show_private_data']
+    else:
+        show = ['-show_entries', entries]
+    cmd = ['ffprobe', '-hide_banner', '-loglevel', 'fatal', '-show_error', *show, '-print_format', 'json', str(path)]
+    output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+    return json.loads(output.decode('utf-8'))
+
+
+def show_entries(chains: t.Iterable[tuple]) -> t.Optional[str]:
+    """Turn the subscripts used on the ffprobe output (see Template.subscripts) into a -show_entries value.
+
+    Returns None if everything has to be probed, because the output is used in a way we can't narrow.
+    """
+    sections: dict[str, t.Optional[set[str]]] = {}
+
+    def want(section: str, entry: t.Optional[str]):
+        if entry is None:
+            sections[section] = None
+        elif sections.get(section, set()) is not None:
+            sections.setdefault(section, set()).add(entry)
+
+    for chain in chains:
+        if not chain or chain[0] not in SECTIONS:
+            return None
+        entries_name, tags_name = SECTIONS[chain[0]]
+        rest = list(chain[1:])
+        if chain[0] == 'streams':
+            # ffprobe['streams'][0][...]
+            if rest and isinstance(rest[0], int):
+                rest.pop(0)
+            elif rest:
+                return None
+        if not rest:
+            want(entries_name, None)
+            want(tags_name, None)
+        elif rest[0] == 'tags':
+            want(tags_name, rest[1] if len(rest) > 1 else None)
+        else:
+            want(entries_name, rest[0])
+
+    if not sections:
+        return None
+    return ':'.join(name if entries is None else f'{name}={",".join(sorted(entries))}' for name, entries in sorted(sections.items()))
+
+
+class ProbePool:
+    """Runs ffprobe in at most `workers` processes at a time.
+
+    Files can be prefetched, so their probe runs while earlier files are being copied, probe() then
+    returns the prefetched result. A prefetched file that is skipped has to be discard()ed.
+    """
+
+    def __init__(self, workers: int, metrics: Metrics = None):
+        self.metrics = metrics
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='ffprobe')
+        self._futures: dict[tuple[str, t.Optional[str]], Future] = {}
+        self._lock = threading.Lock()
+
+    def _future(self, path: str, entries: t.Optional[str], load: t.Callable[[], dict]) -> Future:
+        with self._lock:
+            key = (path, entries)
+            if key not in self._futures:
+                self._futures[key] = self._executor.submit(self._timed, load)
+            return self._futures[key]
+
+    def _timed(self, load: t.Callable[[], dict]) -> dict:
+        if self.metrics is None:
+            return load()
+        with self.metrics.timer('ffprobe_pool_seconds'):
+            return load()
+
+    def prefetch(self, path: str, entries: t.Optional[str] = None, load: t.Callable[[], dict] = None):
+        self._future(path, entries, load or (lambda: probe(path, entries)))
+
+    def probe(self, path: str, entries: t.Optional[str] = None, load: t.Callable[[], dict] = None) -> dict:
+        future = self._future(path, entries, load or (lambda: probe(path, entries)))
+        try:
+            return future.result()
+        finally:
+            with self._lock:
+                self._futures.pop((path, entries), None)
+
+    def discard(self, path: str, entries: t.Optional[str] = None):
+        """Drop the prefetched probe of a file that won't be probed after all, cancelling it if it hasn't started"""
+        with self._lock:
+            future = self._futures.pop((path, entries), None)
+        if future is not None:
+            future.cancel()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        with self._lock:
+            self._futures.clear()
@@ -0,0 +1,51 @@
+import hashlib
+import os
+import typing as t
+
+from utils.copy import BUFFER_SIZE
+
+ALGORITHMS = ('sha1', 'sha256', 'blake2b', 'md5', 'xxhash')
+
+
+class Hasher(t.Protocol):
+    def update(self, data: bytes, /) -> None: ...
+    def digest(self) -> bytes: ...
+
+
+def new_hasher(algorithm: str) -> Hasher:
+    """Create a hash object for one of ALGORITHMS"""
+    if algorithm == 'xxhash':
+        try:
+            import xxhash
+        except ImportError:
+            raise ValueError('The xxhash hash algorithm needs the xxhash package (pip install xxhash)')
+        return xxhash.xxh3_128()
+    if algorithm not in ALGORITHMS:
+        raise ValueError(f'Unknown hash algorithm: {algorithm}')
+    return hashlib.new(algorithm)
+
+
+def hash_file(path: t.Union[os.PathLike, str], algorithm: str, drop_cache=True, chunk_size=BUFFER_SIZE) -> bytes:
+    """Hash a file from disk.
+
+    With drop_cache the file is flushed and evicted from the page cache first (and as it's read),
+    so the digest reflects what is actually on the device, not what we just wrote to memory.
+    """
+    hasher = new_hasher(algorithm)
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as f:
+        fd = f.fileno()
+        if drop_cache:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        offset = 0
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            hasher.update(view[:n])
+            if drop_cache:
+                os.posix_fadvise(fd, offset, n, os.POSIX_FADV_DONTNEED)
+            offset += n
+    return hasher.digest()
@@ -0,0 +1,29 @@
+from contextlib import contextmanager
+import threading
+
+
+class DeviceLimiter:
+    """Limits how many operations run at once on a single device.
+
+    Limits are per role (e.g. 'source' or 'destination') and keyed on st_dev,
+    so two different SD cards can be read at the same time while a single card
+    is only ever read by `limits['source']` workers.
+    """
+
+    def __init__(self, limits: dict[str, int]):
+        self.limits = limits
+        self._semaphores: dict[tuple[str, int], threading.Semaphore] = {}
+        self._lock = threading.Lock()
+
+    def _semaphore(self, role: str, dev: int) -> threading.Semaphore:
+        with self._lock:
+            key = (role, dev)
+            if key not in self._semaphores:
+                self._semaphores[key] = threading.BoundedSemaphore(max(1, int(self.limits[role])))
+            return self._semaphores[key]
+
+    @contextmanager
+    def limit(self, role: str, dev: int):
+        semaphore = self._semaphore(role, dev)
+        with semaphore:
+            yield
@@ -0,0 +1,184 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+import datetime
+import json
+import math
+import os
+from pathlib import Path
+import threading
+import time
+import typing as t
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, math.inf)
+
+# Prefix of the metric names in the Prometheus textfile
+PROMETHEUS_PREFIX = 'ingest_'
+
+Labels = tuple[tuple[str, str], ...]
+
+
+class Histogram:
+    """Latency histogram with fixed buckets, like Prometheus ones"""
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.buckets[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q: float) -> float:
+        """Estimate of the q quantile, interpolated inside its bucket"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            if count and seen + count >= rank:
+                lower = BUCKETS[i - 1] if i else 0.0
+                upper = min(BUCKETS[i], self.max)
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'max': self.max,
+        }
+
+
+def _labels(labels: dict) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _prometheus_labels(labels: t.Iterable[tuple[str, str]]) -> str:
+    text = ','.join(f'{key}="{_escape(value)}"' for key, value in labels)
+    return f'{{{text}}}' if text else ''
+
+
+class Metrics:
+    """Counters and latency histograms of a run, by name and labels (ingest block, device, stage, ...).
+
+    Safe to use from multiple threads. summary() turns them into a JSON friendly run summary,
+    write_prometheus() into a textfile for the node_exporter textfile collector.
+    """
+
+    def __init__(self):
+        self.counters: dict[tuple[str, Labels], float] = {}
+        self.histograms: dict[tuple[str, Labels], Histogram] = {}
+        self.started = datetime.datetime.now(datetime.timezone.utc)
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def count(self, name: str, value: float = 1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._start
+
+    def summary(self, throughput: dict[str, str] = None) -> dict:
+        """Everything recorded so far.
+
+        throughput maps a bytes counter to the histogram of the time spent moving those bytes, for
+        each label set of the counter its bytes per second of busy time and of the whole run are added.
+        """
+        elapsed = self.elapsed()
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {key: histogram.summary() for key, histogram in self.histograms.items()}
+
+        rates = []
+        for bytes_name, seconds_name in (throughput or {}).items():
+            for (name, labels), value in counters.items():
+                if name != bytes_name:
+                    continue
+                busy = histograms.get((seconds_name, labels), {}).get('sum', 0.0)
+                rates.append({
+                    'name': name,
+                    'labels': dict(labels),
+                    'bytes': value,
+                    'busy_seconds': busy,
+                    'bytes_per_busy_second': value / busy if busy else None,
+                    'bytes_per_second': value / elapsed if elapsed else None,
+                })
+
+        return {
+            'started': self.started.isoformat(),
+            'seconds': elapsed,
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(counters.items())],
+            'histograms': [{'name': name, 'labels': dict(labels), **summary} for (name, labels), summary in sorted(histograms.items())],
+            'throughput': rates,
+        }
+
+    def save_json(self, path: Path, throughput: dict[str, str] = None):
+        with open(path, 'w') as f:
+            json.dump(self.summary(throughput), f, indent=2)
+
+    def write_prometheus(self, path: Path):
+        """Write all metrics in the Prometheus text format, replacing the file atomically so a scrape never sees half of it"""
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(h.buckets), h.count, h.sum)) for key, h in self.histograms.items())
+
+        typed = set()
+        for (name, labels), value in counters:
+            metric = f'{PROMETHEUS_PREFIX}{name}_total'
+            if metric not in typed:
+                lines.append(f'# TYPE {metric} counter')
+                typed.add(metric)
+            lines.append(f'{metric}{_prometheus_labels(labels)} {value}')
+
+        for (name, labels), (buckets, count, total) in histograms:
+            metric = f'{PROMETHEUS_PREFIX}{name}'
+            if metric not in typed:
+                lines.append(f'# TYPE {metric} histogram')
+                typed.add(metric)
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS, buckets):
+                cumulative += bucket
+                le = '+Inf' if bound == math.inf else repr(float(bound))
+                lines.append(f'{metric}_bucket{_prometheus_labels((*labels, ("le", le)))} {cumulative}')
+            lines.append(f'{metric}_sum{_prometheus_labels(labels)} {total}')
+            lines.append(f'{metric}_count{_prometheus_labels(labels)} {count}')
+
+        lines.append(f'# TYPE {PROMETHEUS_PREFIX}run_seconds gauge')
+        lines.append(f'{PROMETHEUS_PREFIX}run_seconds {self.elapsed()}')
+
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, path)
@@ -0,0 +1,149 @@
+import datetime
+import struct
+import typing as t
+
+# mvhd times are seconds since this
+EPOCH = datetime.datetime(1904, 1, 1, tzinfo=datetime.timezone.utc)
+
+# Boxes that can start an ISO base media file (MP4, MOV, ...)
+TOP_LEVEL_BOXES = {b'ftyp', b'moov', b'mdat', b'free', b'skip', b'wide', b'pnot', b'uuid'}
+
+# Types of the value in an ilst 'data' box that are text
+TEXT_TYPES = {1, 2, 3, 4, 5}
+
+
+class InvalidMP4Error(ValueError):
+    """Raised when the data isn't an ISO base media file"""
+
+
+def boxes(buf, start: int, end: int) -> t.Generator[tuple[bytes, int, int], None, None]:
+    """Walk the boxes between start and end, yielding (type, content start, content end)"""
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', buf, offset)
+        header = 8
+        if size == 1:
+            if offset + 16 > end:
+                return
+            size, = struct.unpack_from('>Q', buf, offset + 8)
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header or offset + size > end:
+            return
+        yield box_type, offset + header, offset + size
+        offset += size
+
+
+def find(buf, start: int, end: int, box_type: bytes) -> t.Optional[tuple[int, int]]:
+    for found_type, content_start, content_end in boxes(buf, start, end):
+        if found_type == box_type:
+            return content_start, content_end
+    return None
+
+
+def _time(seconds: int) -> t.Optional[datetime.datetime]:
+    # 0 means the camera didn't set it
+    if seconds == 0:
+        return None
+    try:
+        return EPOCH + datetime.timedelta(seconds=seconds)
+    except OverflowError:
+        return None
+
+
+def _mvhd(buf, start: int, end: int) -> dict:
+    version = buf[start]
+    if version == 1 and start + 32 <= end:
+        creation, modification, timescale, duration = struct.unpack_from('>QQIQ', buf, start + 4)
+    elif start + 20 <= end:
+        creation, modification, timescale, duration = struct.unpack_from('>IIII', buf, start + 4)
+    else:
+        return {}
+    return {
+        'creation_time': _time(creation),
+        'modification_time': _time(modification),
+        'timescale': timescale,
+        'duration': duration / timescale if timescale else None,
+    }
+
+
+def _data_value(buf, start: int, end: int):
+    """Value of the 'data' box of an ilst item"""
+    data = find(buf, start, end, b'data')
+    if data is None or data[1] - data[0] < 8:
+        return None
+    data_type, = struct.unpack_from('>I', buf, data[0])
+    value = bytes(buf[data[0] + 8:data[1]])
+    if data_type & 0xffffff in TEXT_TYPES:
+        return value.decode('utf-8', errors='replace')
+    return value
+
+
+def _meta(buf, start: int, end: int, tags: dict):
+    # ISO 'meta' is a full box (with version and flags), QuickTime's isn't and starts with a hdlr box
+    if buf[start + 4:start + 8] != b'hdlr':
+        start += 4
+
+    keys = []
+    keys_box = find(buf, start, end, b'keys')
+    if keys_box is not None:
+        count, = struct.unpack_from('>I', buf, keys_box[0] + 4)
+        offset = keys_box[0] + 8
+        for _ in range(count):
+            if offset + 8 > keys_box[1]:
+                break
+            size, = struct.unpack_from('>I', buf, offset)
+            if size < 8:
+                break
+            keys.append(bytes(buf[offset + 8:offset + size]).decode('utf-8', errors='replace'))
+            offset += size
+
+    ilst = find(buf, start, end, b'ilst')
+    if ilst is None:
+        return
+    for item_type, item_start, item_end in boxes(buf, *ilst):
+        if keys:
+            index, = struct.unpack('>I', item_type)
+            if not 1 <= index <= len(keys):
+                continue
+            key = keys[index - 1]
+        else:
+            key = item_type.decode('latin-1')
+        tags[key] = _data_value(buf, item_start, item_end)
+
+
+def _udta(buf, start: int, end: int, tags: dict):
+    for box_type, content_start, content_end in boxes(buf, start, end):
+        if box_type == b'meta':
+            _meta(buf, content_start, content_end, tags)
+        elif box_type[:1] == b'\xa9' and content_end - content_start >= 4:
+            # Old QuickTime style text: 16 bit length, 16 bit language, text
+            length, = struct.unpack_from('>H', buf, content_start)
+            tags[box_type.decode('latin-1')] = bytes(buf[content_start + 4:content_start + 4 + length]).decode('utf-8', errors='replace')
+
+
+def load(buf) -> dict:
+    """Read the movie header and metadata of an MP4/MOV file.
+
+    buf is anything that supports the buffer protocol, like a mmap of the file. Only box headers and
+    the moov box are read, the media data is skipped over.
+    """
+    end = len(buf)
+    if end < 8 or struct.unpack_from('>4s', buf, 4)[0] not in TOP_LEVEL_BOXES:
+        raise InvalidMP4Error('Given data isn\'t an MP4/MOV file.')
+
+    data = {'brand': None, 'creation_time': None, 'modification_time': None, 'timescale': None, 'duration': None, 'tags': {}}
+    for box_type, start, box_end in boxes(buf, 0, end):
+        if box_type == b'ftyp' and box_end - start >= 4:
+            data['brand'] = bytes(buf[start:start + 4]).decode('latin-1').strip()
+        elif box_type == b'moov':
+            for child_type, child_start, child_end in boxes(buf, start, box_end):
+                if child_type == b'mvhd':
+                    data.update(_mvhd(buf, child_start, child_end))
+                elif child_type == b'udta':
+                    _udta(buf, child_start, child_end, data['tags'])
+                elif child_type == b'meta':
+                    _meta(buf, child_start, child_end, data['tags'])
+            break
+    return data
@@ -4,31 +4,173 @@ import os
 import re
 import typing as t
 from pathlib import Path
-import stat
+
+class FileStat:
+    """The fields of an os.stat_result that ingesting uses, in a fraction of its memory"""
+
+    __slots__ = ('st_size', 'st_mtime_ns', 'st_ctime_ns', 'st_dev', 'st_ino', 'st_mode')
+
+    def __init__(self, st: os.stat_result):
+        self.st_size = st.st_size
+        self.st_mtime_ns = st.st_mtime_ns
+        self.st_ctime_ns = st.st_ctime_ns
+        self.st_dev = st.st_dev
+        self.st_ino = st.st_ino
+        self.st_mode = st.st_mode
+
+    # Computed like os.stat does, so they're the exact same floats
+    @property
+    def st_mtime(self) -> float:
+        seconds, nanoseconds = divmod(self.st_mtime_ns, 1000000000)
+        return seconds + nanoseconds * 1e-9
+
+    @property
+    def st_ctime(self) -> float:
+        seconds, nanoseconds = divmod(self.st_ctime_ns, 1000000000)
+        return seconds + nanoseconds * 1e-9
 
 class PathMatch:
-    def __init__(self, path: Path, match: t.Match, stat: os.stat_result):
+    # A re.Match is kept as is, it's only the group spans and a reference to the path string
+    __slots__ = ('path', 'match', 'stat')
+
+    def __init__(self, path: Path, match: t.Match, stat: t.Union[os.stat_result, FileStat]):
         self.path = path
         self.match = match
-        self.stat = stat
+        self.stat = stat if isinstance(stat, FileStat) else FileStat(stat)
 
     def __repr__(self):
         return f'PathMatch({self.path}, {self.match})'
 
-def re_glob(path: Path, pattern: str) -> t.Generator[PathMatch, None, None]:
-    """Recursively glob a path with a regex pattern"""
+# Flags that change how the whole pattern matches, we can't split a pattern that uses them into components
+_INLINE_FLAGS = re.compile(r'\(\?[aiLmsux]')
+
+def _tokens(pattern: str) -> t.Generator[tuple[str, int, bool], None, None]:
+    """Walk a regex, yielding (token, group depth, inside a character class) for every char or escape"""
+    depth = 0
+    in_class = False
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            yield pattern[i:i + 2], depth, in_class
+            i += 2
+            continue
+        if in_class:
+            if c == ']':
+                in_class = False
+        elif c == '[':
+            in_class = True
+            yield c, depth, False
+            # A ']' right after '[' or '[^' is part of the class
+            if pattern[i + 1:i + 2] == '^':
+                yield '^', depth, True
+                i += 1
+            if pattern[i + 1:i + 2] == ']':
+                i += 1
+            i += 1
+            continue
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        yield c, depth, in_class
+        i += 1
+
+def _is_plain_component(part: str) -> bool:
+    """Check that a path component of a regex can never match a '/' and doesn't depend on other components"""
+    depth, in_class = 0, False
+    for token, depth, in_class in _tokens(part):
+        if depth < 0:
+            return False
+        if token.startswith('\\') and (len(token) < 2 or token[1] in 'DWS' or token[1].isdigit()):
+            return False
+        if in_class:
+            # Negated classes can match a '/'
+            if token == '^':
+                return False
+        elif token == '.' or (token == '|' and depth == 0):
+            return False
+    return depth == 0 and not in_class
+
+def split_components(pattern: str) -> tuple[list[t.Pattern], bool]:
+    """Split a regex for a relative path into one compiled regex per directory level.
+
+    Returns the directory patterns, stopping at the first level that might match a '/' (e.g. '.*'),
+    and whether every level was split, in which case matching files can only be exactly that deep.
+    """
+    if _INLINE_FLAGS.search(pattern) or any(token == '|' and depth == 0 and not in_class for token, depth, in_class in _tokens(pattern)):
+        return [], False
+    parts = pattern.split('/')
+    components = []
+    for part in parts[:-1]:
+        if not _is_plain_component(part):
+            return components, False
+        try:
+            components.append(re.compile(f'(?:{part})\\Z'))
+        except re.error:
+            return components, False
+    return components, _is_plain_component(parts[-1])
+
+# os.scandir, or anything with the same interface
+Scandir = t.Callable[[str], t.ContextManager[t.Iterable[os.DirEntry]]]
+
+def _scan(path: str, regex: t.Pattern, components: list[t.Pattern], exact_depth: bool, depth: int, scandir: Scandir) -> t.Generator[PathMatch, None, None]:
+    try:
+        it = scandir(path)
+    except FileNotFoundError:
+        if depth == 0:
+            raise
+        return
+    with it:
+        entries = list(it)
+    for entry in entries:
+        try:
+            if entry.is_dir():
+                if exact_depth and depth >= len(components):
+                    continue
+                if depth < len(components) and not components[depth].match(entry.name):
+                    continue
+                yield from _scan(entry.path, regex, components, exact_depth, depth + 1, scandir)
+            elif entry.is_file():
+                if match := regex.match(entry.path):
+                    yield PathMatch(Path(entry.path), match, entry.stat())
+        except FileNotFoundError:
+            # Removed while we were scanning
+            continue
+
+def re_glob(path: Path, pattern: t.Union[str, t.Pattern], scandir: Scandir = os.scandir) -> t.Generator[PathMatch, None, None]:
+    """Recursively glob a path with a regex pattern.
+
+    Directories are only descended into if the part of the pattern for their depth can match them,
+    which works when the pattern is anchored at the path (e.g. '^/media/card/DCIM/(\\d+)/.+\\.JPG$').
+    Directories are listed with scandir, which can be swapped for a cached listing (see ScanIndex).
+    """
+    regex = re.compile(pattern) if isinstance(pattern, str) else pattern
+
+    components, exact_depth = [], False
+    root = f'^{path}/'
+    if regex.pattern.startswith(root) and regex.pattern.endswith('$'):
+        components, exact_depth = split_components(regex.pattern[len(root):-1])
+
     try:
-        for subpath in path.iterdir():
-            s = subpath.stat()
-            if stat.S_ISDIR(s.st_mode):
-                yield from re_glob(subpath, pattern)
-            elif stat.S_ISREG(s.st_mode):
-                if match := re.match(pattern, str(subpath)):
-                    yield PathMatch(subpath, match, s)
+        yield from _scan(str(path), regex, components, exact_depth, 0, scandir)
     except FileNotFoundError:
         logging.warning(f'Ingest source path not found: {path}')
         raise FileNotFoundError
 
+def device_of(path: Path) -> int:
+    """Get the st_dev of a path, or of its closest existing parent if it doesn't exist yet"""
+    for p in (path, *path.parents):
+        try:
+            return p.stat().st_dev
+        except FileNotFoundError:
+            continue
+    raise FileNotFoundError(path)
+
+def device_label(dev: int) -> str:
+    """major:minor of a st_dev, like in /proc/self/mountinfo"""
+    return f'{os.major(dev)}:{os.minor(dev)}'
+
 # ChatGPT wrote this lmao
 def longest_path_part(string_with_regex):
     # Split the input string into parts using "/"
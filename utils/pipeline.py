@@ -0,0 +1,260 @@
+import bisect
+from collections import OrderedDict, deque
+import itertools
+import threading
+import time
+import typing as t
+
+# Returned by StageQueue.get once the queue is closed and empty (or aborted)
+CLOSED = object()
+# Returned by StageQueue.get when it timed out
+EMPTY = object()
+
+
+class StageQueue:
+    """Bounded FIFO queue between two pipeline stages.
+
+    put() blocks while the queue is full, which is what keeps a fast stage from running
+    arbitrarily far ahead of a slow one.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = max(1, maxsize)
+        self._cond = threading.Condition()
+        self._closed = False
+        self._aborted = False
+        self._items = deque()
+
+    def _size(self) -> int:
+        return len(self._items)
+
+    def _has_ready(self) -> bool:
+        return bool(self._items)
+
+    def _pop(self):
+        return self._items.popleft()
+
+    def _push(self, item):
+        self._items.append(item)
+
+    def put(self, item):
+        with self._cond:
+            while self._size() >= self.maxsize and not self._aborted:
+                self._cond.wait()
+            if self._aborted:
+                return
+            self._push(item)
+            self._cond.notify_all()
+
+    def get(self, timeout: float = None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while not self._aborted and not self._has_ready():
+                if self._closed and self._size() == 0:
+                    return CLOSED
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return EMPTY
+                self._cond.wait(remaining)
+            if self._aborted:
+                return CLOSED
+            item = self._pop()
+            self._cond.notify_all()
+            return item
+
+    def done(self, item):
+        """Called once a worker is done with an item it got"""
+
+    def close(self):
+        """No more items will be put, get() returns CLOSED once the queue is empty"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def abort(self):
+        """Drop everything, and wake up everyone waiting"""
+        with self._cond:
+            self._aborted = True
+            self._items.clear()
+            self._cond.notify_all()
+
+
+class DeviceQueue(StageQueue):
+    """Stage queue that hands out at most `limit` items per device at a time.
+
+    Items are kept in one queue per device (from key(item)), and get() takes from the devices in
+    turn, skipping busy ones, so a slow device never blocks workers that could use another one.
+    Each device's items are handed out in order of order(item) (e.g. where they are on the disk),
+    sweeping up from the last one handed out and then starting over from the lowest (C-SCAN), so
+    items that arrive behind the sweep wait at most one sweep. Without order they are handed out FIFO.
+    """
+
+    def __init__(self, maxsize: int, key: t.Callable[[t.Any], t.Hashable], limit: int, order: t.Callable[[t.Any], t.Any] = None):
+        super().__init__(maxsize)
+        self.key = key
+        self.limit = max(1, limit)
+        self.order = order
+        # Device -> sorted (order, arrival, item)
+        self._queues: OrderedDict[t.Hashable, list[tuple]] = OrderedDict()
+        # Device -> (order, arrival) of the last item handed out
+        self._positions: dict[t.Hashable, tuple] = {}
+        self._running: dict[t.Hashable, int] = {}
+        self._arrivals = itertools.count()
+        self._count = 0
+
+    def _size(self) -> int:
+        return self._count
+
+    def _ready(self):
+        for key, queue in self._queues.items():
+            if queue and self._running.get(key, 0) < self.limit:
+                return key
+        return None
+
+    def _has_ready(self) -> bool:
+        return self._ready() is not None
+
+    def _next_index(self, key: t.Hashable) -> int:
+        queue = self._queues[key]
+        i = bisect.bisect_right(queue, self._positions[key]) if key in self._positions else 0
+        return i if i < len(queue) else 0
+
+    def _pop(self):
+        key = self._ready()
+        order, arrival, item = self._queues[key].pop(self._next_index(key))
+        self._positions[key] = (order, arrival)
+        # Round robin between devices
+        self._queues.move_to_end(key)
+        self._running[key] = self._running.get(key, 0) + 1
+        self._count -= 1
+        return item
+
+    def _push(self, item):
+        order = self.order(item) if self.order is not None else 0
+        bisect.insort(self._queues.setdefault(self.key(item), []), (order, next(self._arrivals), item))
+        self._count += 1
+
+    def peek(self, key: t.Hashable):
+        """The item of a device that would be handed out next, or None"""
+        with self._cond:
+            if not self._queues.get(key):
+                return None
+            return self._queues[key][self._next_index(key)][2]
+
+    def done(self, item):
+        with self._cond:
+            key = self.key(item)
+            self._running[key] -= 1
+            self._cond.notify_all()
+
+    def abort(self):
+        with self._cond:
+            self._queues.clear()
+            self._count = 0
+        super().abort()
+
+
+class Stage:
+    def __init__(self, name: str, func: t.Callable, workers: int, queue: StageQueue, flat: bool, batch: int, batch_timeout: float):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.queue = queue
+        self.flat = flat
+        self.batch = batch
+        self.batch_timeout = batch_timeout
+
+
+class Pipeline:
+    """Runs items through a chain of stages, each with its own worker threads, connected by bounded queues.
+
+    A stage's func gets one item and returns the item to pass on, or None to drop it. With flat=True
+    it returns an iterable of items to pass on instead, and with batch=N it gets lists of up to N items
+    (and returns an iterable). If any stage raises, the whole pipeline is aborted and run() re-raises.
+    """
+
+    def __init__(self, queue_size: int = 64):
+        self.queue_size = queue_size
+        self.stages: list[Stage] = []
+        self._error: BaseException = None
+        self._error_lock = threading.Lock()
+
+    def add(self, name: str, func: t.Callable, workers: int = 1, queue: StageQueue = None, flat=False, batch: int = None, batch_timeout: float = 0.5) -> 'Pipeline':
+        queue = queue if queue is not None else StageQueue(self.queue_size)
+        self.stages.append(Stage(name, func, workers, queue, flat or batch is not None, batch, batch_timeout))
+        return self
+
+    def _fail(self, e: BaseException):
+        with self._error_lock:
+            if self._error is None:
+                self._error = e
+        for stage in self.stages:
+            stage.queue.abort()
+
+    def _worker(self, stage: Stage, out: t.Optional[StageQueue]):
+        def emit(result):
+            if out is None:
+                return
+            if stage.flat:
+                for r in result or ():
+                    out.put(r)
+            elif result is not None:
+                out.put(result)
+
+        batch = []
+        try:
+            while True:
+                item = stage.queue.get(timeout=stage.batch_timeout if batch else None)
+                if item is EMPTY or item is CLOSED:
+                    if batch:
+                        emit(stage.func(batch))
+                        batch = []
+                    if item is CLOSED:
+                        return
+                    continue
+
+                if stage.batch is not None:
+                    stage.queue.done(item)
+                    batch.append(item)
+                    if len(batch) >= stage.batch:
+                        emit(stage.func(batch))
+                        batch = []
+                    continue
+
+                try:
+                    result = stage.func(item)
+                finally:
+                    stage.queue.done(item)
+                emit(result)
+        except BaseException as e:
+            self._fail(e)
+
+    def run(self, source: t.Iterable):
+        """Feed all items from source into the first stage, and wait for everything to go through"""
+        workers: list[list[threading.Thread]] = []
+        for i, stage in enumerate(self.stages):
+            out = self.stages[i + 1].queue if i + 1 < len(self.stages) else None
+            threads = [threading.Thread(target=self._worker, args=(stage, out), name=f'{stage.name}-{n}', daemon=True) for n in range(stage.workers)]
+            for thread in threads:
+                thread.start()
+            workers.append(threads)
+
+        try:
+            for item in source:
+                if self._error is not None:
+                    break
+                self.stages[0].queue.put(item)
+            self.stages[0].queue.close()
+
+            # Once every worker of a stage is done, nothing more goes into the next one
+            for i, threads in enumerate(workers):
+                for thread in threads:
+                    thread.join()
+                if i + 1 < len(self.stages):
+                    self.stages[i + 1].queue.close()
+        except BaseException as e:
+            self._fail(e)
+            raise
+
+        if self._error is not None:
+            raise self._error
@@ -0,0 +1,68 @@
+from collections import defaultdict
+import csv
+import json
+from pathlib import Path
+import threading
+
+# Why a file wouldn't be copied
+SKIP_INGESTED = 'ingested'
+SKIP_DUPLICATE_SOURCE = 'duplicate source'
+SKIP_COLLISION = 'collision'
+SKIP_EXISTS = 'exists'
+SKIP_EXISTS_DIFFERENT_SIZE = 'exists with different size'
+
+FIELDS = ('block', 'source', 'destination', 'size', 'mtime', 'skip', 'collision')
+
+
+class Plan:
+    """What an ingest would do, without doing it: every scanned file with the destination it would be
+    copied to, or why it would be skipped, and how much time each stage spent on each ingest block.
+
+    Entries are dicts with FIELDS. skip is None for files that would be copied (one entry per
+    destination), collision is the source that already claimed the same destination.
+    """
+
+    def __init__(self, entries: list[dict] = None, timings: dict[str, dict[str, float]] = None):
+        self.entries: list[dict] = entries or []
+        # stage -> ingest block name -> seconds, summed over all workers
+        self.timings: defaultdict[str, defaultdict[str, float]] = defaultdict(lambda: defaultdict(float))
+        for stage, blocks in (timings or {}).items():
+            self.timings[stage].update(blocks)
+        self._lock = threading.Lock()
+
+    def add(self, block: str, source: str, size: int, mtime: int, destination: str = None, skip: str = None, collision: str = None):
+        with self._lock:
+            self.entries.append({'block': block, 'source': source, 'destination': destination, 'size': size, 'mtime': mtime, 'skip': skip, 'collision': collision})
+
+    def add_time(self, stage: str, block: str, seconds: float):
+        with self._lock:
+            self.timings[stage][block] += seconds
+
+    def copies(self) -> list[dict]:
+        """Entries of the files that would be copied"""
+        return [entry for entry in self.entries if entry['skip'] is None]
+
+    def save(self, path: Path):
+        """Write the plan as JSON, or as CSV (without the timings) if path ends in .csv"""
+        entries = sorted(self.entries, key=lambda entry: (entry['block'], entry['source'], entry['destination'] or ''))
+        with open(path, 'w', newline='') as f:
+            if Path(path).suffix.lower() == '.csv':
+                writer = csv.DictWriter(f, FIELDS)
+                writer.writeheader()
+                writer.writerows(entries)
+            else:
+                json.dump({'entries': entries, 'timings': self.timings}, f, indent=2)
+
+    @classmethod
+    def load(cls, path: Path) -> 'Plan':
+        with open(path, 'r', newline='') as f:
+            if Path(path).suffix.lower() == '.csv':
+                entries = []
+                for row in csv.DictReader(f):
+                    # Everything is a string in CSV, and None is written as ''
+                    entry = {key: value or None for key, value in row.items()}
+                    entry['size'], entry['mtime'] = int(entry['size']), int(entry['mtime'])
+                    entries.append(entry)
+                return cls(entries)
+            data = json.load(f)
+            return cls(data['entries'], data.get('timings'))
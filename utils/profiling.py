@@ -0,0 +1,48 @@
+import cProfile
+from contextlib import contextmanager
+from pathlib import Path
+import pstats
+import sys
+import threading
+import typing as t
+
+# From 3.12 cProfile is built on sys.monitoring, one profiler sees every thread (and only one can be active)
+PROFILES_ALL_THREADS = sys.version_info >= (3, 12)
+
+
+@contextmanager
+def profile(path: t.Union[Path, str]):
+    """Profile everything that runs inside the block with cProfile, and save the stats to path.
+
+    Before Python 3.12 cProfile only sees the thread it was enabled in, so every thread started
+    inside the block gets its own profiler, and they're all merged into one file (readable with
+    pstats or snakeviz). From 3.12 the profiler of the main thread sees all of them.
+    """
+    profilers: list[cProfile.Profile] = []
+    lock = threading.Lock()
+
+    def start_thread(frame, event, arg):
+        # Called on the first event of a new thread, enable() then replaces this hook for that thread
+        profiler = cProfile.Profile()
+        with lock:
+            profilers.append(profiler)
+        profiler.enable()
+
+    main = cProfile.Profile()
+    if not PROFILES_ALL_THREADS:
+        threading.setprofile(start_thread)
+    main.enable()
+    try:
+        yield
+    finally:
+        main.disable()
+        if not PROFILES_ALL_THREADS:
+            threading.setprofile(None)
+        stats = pstats.Stats(main)
+        with lock:
+            for profiler in profilers:
+                # A thread that never made a call has nothing to merge (pstats refuses empty profilers)
+                profiler.create_stats()
+                if profiler.stats:
+                    stats.add(profiler)
+        stats.dump_stats(path)
@@ -0,0 +1,107 @@
+import csv
+import datetime
+import json
+import sqlite3
+import typing as t
+
+from utils.db import INGEST_BLOCK_NAME
+
+# Columns of each result, digest is hex
+FIELDS = ('source', 'destination', 'size', 'mtime', 'digest', 'hash_algorithm', 'ingested_at')
+
+
+def prefix_range(prefix: str) -> tuple[str, str]:
+    """The [low, high) range of the strings that start with prefix, which (unlike LIKE) can use an index"""
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _ns(value: datetime.datetime) -> int:
+    return round(value.timestamp() * 1_000_000_000)
+
+
+def query(
+    db: sqlite3.Connection,
+    source: str = None,
+    destination: str = None,
+    digest: bytes = None,
+    missing_digest: bool = False,
+    since: datetime.datetime = None,
+    before: datetime.datetime = None,
+    limit: int = None,
+) -> t.Iterator[dict]:
+    """Find copied files in the files table, as dicts with FIELDS, one row at a time.
+
+    source and destination are path prefixes. since and before limit when the files were ingested,
+    rows from before that was recorded have no ingest time and only match without them.
+    Every condition has an index, and rows come out in the order of the one the lookup goes through,
+    so nothing has to be read (or sorted) up front.
+    """
+    conditions = []
+    params = []
+    order = None
+    if since is not None or before is not None:
+        conditions.append('ingested_at >= ? AND ingested_at < ?')
+        params += [_ns(since) if since is not None else 0, _ns(before) if before is not None else 2 ** 63 - 1]
+        order = 'ingested_at'
+    if missing_digest:
+        conditions.append('sha1 IS NULL')
+        order = 'sha1'
+    if destination:
+        conditions.append('destination >= ? AND destination < ?')
+        params += prefix_range(destination)
+        order = 'destination'
+    if source:
+        # The primary key starts with (ingest_block_name, source)
+        conditions.append('ingest_block_name = ? AND source >= ? AND source < ?')
+        params += [INGEST_BLOCK_NAME, *prefix_range(source)]
+        order = 'source'
+    if digest is not None:
+        conditions.append('sha1 = ?')
+        params.append(digest)
+        order = 'sha1'
+
+    sql = 'SELECT source, destination, size, mtime, sha1, hash_algorithm, ingested_at FROM files'
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    if order is not None:
+        sql += f' ORDER BY {order}'
+    if limit is not None:
+        sql += ' LIMIT ?'
+        params.append(limit)
+
+    for source, destination, size, mtime, sha1, algorithm, ingested_at in db.execute(sql, params):
+        yield {
+            'source': source,
+            'destination': destination,
+            'size': size,
+            'mtime': mtime,
+            'digest': sha1.hex() if sha1 is not None else None,
+            'hash_algorithm': algorithm,
+            'ingested_at': datetime.datetime.fromtimestamp(ingested_at / 1e9).isoformat(timespec='seconds') if ingested_at is not None else None,
+        }
+
+
+def write_json(rows: t.Iterable[dict], f: t.TextIO) -> int:
+    """Write rows as a JSON array, one row per line as they come, returns how many there were"""
+    count = 0
+    f.write('[')
+    for row in rows:
+        f.write(',\n' if count else '\n')
+        f.write(json.dumps(row))
+        count += 1
+    f.write('\n]\n' if count else ']\n')
+    return count
+
+
+def write_csv(rows: t.Iterable[dict], f: t.TextIO) -> int:
+    """Write rows as CSV with a header, as they come, returns how many there were"""
+    writer = csv.DictWriter(f, FIELDS)
+    writer.writeheader()
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    return count
+
+
+WRITERS = {'json': write_json, 'csv': write_csv}
@@ -0,0 +1,47 @@
+import fcntl
+import os
+import struct
+import typing as t
+
+# ioctl to get the extents of a file (linux/fiemap.h)
+FS_IOC_FIEMAP = 0xC020660B
+# struct fiemap: fm_start, fm_length, fm_flags, fm_mapped_extents, fm_extent_count, fm_reserved
+FIEMAP = struct.Struct('=QQIIII')
+# struct fiemap_extent: fe_logical, fe_physical, fe_length, fe_reserved64[2], fe_flags, fe_reserved[3]
+FIEMAP_EXTENT = struct.Struct('=QQQ2QI3I')
+
+# How the files of a source device are ordered for copying:
+# 'physical' by where their first extent is on the device (falling back to 'inode' where FIEMAP isn't supported),
+# 'inode' by inode number (roughly creation order on most filesystems), 'scan' in the order they were found
+READ_ORDERS = ('physical', 'inode', 'scan')
+
+
+def physical_offset(fd: int) -> t.Optional[int]:
+    """Where on the device the file's first extent is, None if the filesystem can't tell (or the file is empty)"""
+    buf = bytearray(FIEMAP.size + FIEMAP_EXTENT.size)
+    FIEMAP.pack_into(buf, 0, 0, 2 ** 64 - 1, 0, 0, 1, 0)
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, buf)
+    except OSError:
+        return None
+    if FIEMAP.unpack_from(buf)[3] == 0:
+        return None
+    return FIEMAP_EXTENT.unpack_from(buf, FIEMAP.size)[1]
+
+
+def read_position(strategy: str, fd: int, st: os.stat_result) -> tuple:
+    """Sort key of a file for a read order strategy.
+
+    Keys of different strategies sort apart (physical, then inode, then scan order), so files of
+    blocks with different strategies on the same device can still share a queue.
+    """
+    if strategy not in READ_ORDERS:
+        raise ValueError(f'Unknown read order: {strategy} (expected one of {", ".join(READ_ORDERS)})')
+    if strategy == 'physical':
+        offset = physical_offset(fd)
+        if offset is not None:
+            return (0, offset)
+    if strategy in ('physical', 'inode'):
+        return (1, st.st_ino)
+    # Ties are handed out in arrival order
+    return (2, 0)
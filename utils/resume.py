@@ -0,0 +1,119 @@
+from pathlib import Path
+import sqlite3
+import threading
+import typing as t
+
+from utils.copy import BUFFER_SIZE
+from utils.hashing import new_hasher
+
+
+def part_path(path: Path) -> Path:
+    """Where a copy to path is written until it's complete, next to it so the final rename is atomic"""
+    return path.with_name(f'.{path.name}.part')
+
+
+class Checkpoints:
+    """Digests of every chunk_size chunk of the files being copied, stored in the db as the copy goes.
+
+    They are of the source, keyed by its path, size and mtime. When a copy is interrupted, the
+    chunks of the partial copy that match them don't have to be copied again.
+    """
+
+    def __init__(self, db: sqlite3.Connection, lock: threading.Lock, chunk_size: int):
+        self.db = db
+        self.lock = lock
+        self.chunk_size = chunk_size
+        with self.lock:
+            self.db.execute('CREATE TABLE IF NOT EXISTS copy_checkpoints (source TEXT NOT NULL, size INTEGER NOT NULL, mtime INTEGER NOT NULL, chunk_size INTEGER NOT NULL, hash_algorithm TEXT NOT NULL, chunk INTEGER NOT NULL, digest BLOB NOT NULL, PRIMARY KEY(source, size, mtime, chunk))')
+
+    @property
+    def enabled(self) -> bool:
+        return self.chunk_size > 0
+
+    def wanted(self, size: int) -> bool:
+        """Whether a file is big enough to be worth checkpointing"""
+        return self.enabled and size > self.chunk_size
+
+    def load(self, source: str, size: int, mtime: int, algorithm: str) -> list[bytes]:
+        """Digests of the consecutive chunks checkpointed so far, from the first one"""
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT chunk, digest FROM copy_checkpoints WHERE source = ? AND size = ? AND mtime = ? AND chunk_size = ? AND hash_algorithm = ? ORDER BY chunk',
+                (source, size, mtime, self.chunk_size, algorithm),
+            ).fetchall()
+        digests = []
+        for chunk, digest in rows:
+            if chunk != len(digests):
+                break
+            digests.append(digest)
+        return digests
+
+    def add(self, source: str, size: int, mtime: int, algorithm: str, chunk: int, digest: bytes):
+        # Committed right away, it has to survive whatever interrupts the copy
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO copy_checkpoints VALUES (?, ?, ?, ?, ?, ?, ?)', (source, size, mtime, self.chunk_size, algorithm, chunk, digest))
+
+    def clear(self, source: str):
+        with self.lock:
+            self.db.execute('DELETE FROM copy_checkpoints WHERE source = ?', (source,))
+
+
+class ChunkHasher:
+    """Hashes a stream per chunk_size chunk, calling on_chunk(index, digest) for each full chunk.
+
+    Every update is also passed on to hasher (for the digest of the whole file), so it can be given
+    to transfer() in place of it.
+    """
+
+    def __init__(self, algorithm: str, chunk_size: int, on_chunk: t.Callable[[int, bytes], None], hasher=None, first_chunk: int = 0):
+        self.algorithm = algorithm
+        self.chunk_size = chunk_size
+        self.on_chunk = on_chunk
+        self.hasher = hasher
+        self.index = first_chunk
+        self._chunk = new_hasher(algorithm)
+        self._filled = 0
+
+    def update(self, data):
+        if self.hasher is not None:
+            self.hasher.update(data)
+        with memoryview(data) as view:
+            while len(view):
+                n = min(len(view), self.chunk_size - self._filled)
+                self._chunk.update(view[:n])
+                self._filled += n
+                view = view[n:]
+                if self._filled == self.chunk_size:
+                    self.on_chunk(self.index, self._chunk.digest())
+                    self.index += 1
+                    self._chunk = new_hasher(self.algorithm)
+                    self._filled = 0
+
+
+def verify_part(path: Path, digests: list[bytes], algorithm: str, chunk_size: int, hasher=None) -> tuple[int, t.Any]:
+    """Check the chunks of a partial copy against their checkpoint digests.
+
+    Returns how many bytes from the start are good, and hasher (if given) fed with exactly those
+    bytes. Reading stops at the first chunk that doesn't match.
+    """
+    offset = 0
+    good = hasher.copy() if hasher is not None else None
+    with open(path, 'rb', buffering=0) as f:
+        buf = bytearray(min(BUFFER_SIZE, chunk_size))
+        for digest in digests:
+            chunk = new_hasher(algorithm)
+            read = 0
+            while read < chunk_size:
+                n = f.readinto(memoryview(buf)[:min(len(buf), chunk_size - read)])
+                if not n:
+                    return offset, good
+                with memoryview(buf) as view:
+                    chunk.update(view[:n])
+                    if hasher is not None:
+                        hasher.update(view[:n])
+                read += n
+            if chunk.digest() != digest:
+                return offset, good
+            offset += chunk_size
+            good = hasher.copy() if hasher is not None else None
+    return offset, good
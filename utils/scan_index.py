@@ -0,0 +1,143 @@
+import marshal
+import os
+import sqlite3
+import threading
+import time
+import typing as t
+
+from utils.metrics import Metrics
+
+# A directory (or file) changed less than this long before it was listed (or stat'ed) might change
+# again within the same mtime tick, or still be being written, so it isn't stored (like git's "racily
+# clean" entries)
+RACY_NS = 2 * 1000 * 1000 * 1000
+
+# Fields of os.stat_result that aren't in its tuple
+STAT_EXTRA_FIELDS = ('st_atime', 'st_mtime', 'st_ctime', 'st_atime_ns', 'st_mtime_ns', 'st_ctime_ns', 'st_blksize', 'st_blocks')
+
+
+def _stat_record(st: os.stat_result) -> tuple:
+    return tuple(st), {name: getattr(st, name) for name in STAT_EXTRA_FIELDS}
+
+
+def _stat_result(record: tuple) -> os.stat_result:
+    return os.stat_result(*record)
+
+
+class IndexedEntry:
+    """A directory entry from a Listing, with the same interface as os.DirEntry"""
+
+    __slots__ = ('listing', 'record', 'name', 'path')
+
+    def __init__(self, listing: 'Listing', record: list):
+        self.listing = listing
+        # [name, is_dir, is_file, stat record or None]
+        self.record = record
+        self.name = record[0]
+        self.path = os.path.join(listing.path, self.name)
+
+    def is_dir(self) -> bool:
+        return self.record[1]
+
+    def is_file(self) -> bool:
+        return self.record[2]
+
+    def stat(self) -> os.stat_result:
+        if self.record[3] is not None:
+            return _stat_result(self.record[3])
+        st = os.stat(self.path)
+        # Writing to a file doesn't change its directory's mtime, a stat stored now could be served forever
+        if time.time_ns() - max(st.st_mtime_ns, st.st_ctime_ns) > self.listing.index.racy_ns:
+            self.record[3] = _stat_record(st)
+            self.listing.changed()
+        return st
+
+
+class Listing:
+    """The entries of one directory, either from the index or freshly listed"""
+
+    def __init__(self, index: 'ScanIndex', path: str, mtime: int, records: list[list], cacheable: bool):
+        self.index = index
+        self.path = path
+        self.mtime = mtime
+        self.records = records
+        self.cacheable = cacheable
+
+    def changed(self):
+        if self.cacheable:
+            self.index._changed(self)
+
+    def __iter__(self) -> t.Iterator[IndexedEntry]:
+        return (IndexedEntry(self, record) for record in self.records)
+
+    def __enter__(self) -> 'Listing':
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+class ScanIndex:
+    """Listings of scanned directories stored in the db, keyed by path and valid as long as the directory's mtime is the same.
+
+    scandir() is a drop-in for os.scandir (see re_glob). A directory that hasn't changed since it was
+    last scanned is served from the index, with the stats of the files that were matched in it,
+    instead of being listed again. Files that are modified in place (which doesn't change their
+    directory's mtime) keep their old stat, so stats of files changed less than racy_ns before are
+    never stored, and forget() drops a listing that turned out to be stale.
+    """
+
+    def __init__(self, db: sqlite3.Connection, lock: threading.Lock, max_pending: int = 500, metrics: Metrics = None, racy_ns: int = RACY_NS):
+        self.db = db
+        self.lock = lock
+        self.max_pending = max_pending
+        self.racy_ns = racy_ns
+        self.metrics = metrics
+        self._pending: dict[str, Listing] = {}
+        self._pending_lock = threading.Lock()
+        with self.lock:
+            self.db.execute('CREATE TABLE IF NOT EXISTS scan_index (path TEXT PRIMARY KEY, mtime INTEGER NOT NULL, entries BLOB NOT NULL)')
+
+    def scandir(self, path: str) -> Listing:
+        path = os.fspath(path)
+        mtime = os.stat(path).st_mtime_ns
+        with self.lock:
+            row = self.db.execute('SELECT mtime, entries FROM scan_index WHERE path = ?', (path,)).fetchone()
+        hit = row is not None and row[0] == mtime
+        if self.metrics is not None:
+            self.metrics.count('scan_index_hits' if hit else 'scan_index_misses')
+        if hit:
+            return Listing(self, path, mtime, marshal.loads(row[1]), cacheable=True)
+
+        with os.scandir(path) as it:
+            records = [[entry.name, entry.is_dir(), entry.is_file(), None] for entry in it]
+        listing = Listing(self, path, mtime, records, cacheable=time.time_ns() - mtime > self.racy_ns)
+        listing.changed()
+        return listing
+
+    def _changed(self, listing: Listing):
+        with self._pending_lock:
+            self._pending[listing.path] = listing
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Write the listings that changed"""
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        rows = [(listing.path, listing.mtime, marshal.dumps(listing.records)) for listing in pending.values()]
+        with self.lock:
+            with self.db:
+                self.db.execute('BEGIN')
+                self.db.executemany('INSERT OR REPLACE INTO scan_index (path, mtime, entries) VALUES (?, ?, ?)', rows)
+
+    def forget(self, path: str):
+        """Drop the listing of a directory, it's listed again the next time it's scanned"""
+        path = os.fspath(path)
+        with self._pending_lock:
+            self._pending.pop(path, None)
+        with self.lock:
+            self.db.execute('DELETE FROM scan_index WHERE path = ?', (path,))
@@ -1,7 +1,7 @@
 
 
+import ast as pyast
 import copy
-import io
 import re
 
 from datetime import datetime
@@ -15,12 +15,12 @@ EVAL_CLOSE = '}}'
 EXEC_OPEN = '{%'
 EXEC_CLOSE = '%}'
 
-class Source(str):
-    def __getitem__(self, __i) -> str:
-        if not isinstance(__i, slice):
-            __i = slice(__i, __i+1)
-        __i = slice(max(__i.start, 0), min(__i.stop, len(self)))
-        return Source(super().__getitem__(__i))
+# Splits a template on its tags, keeping them. Alternatives are tried in the same order as the tags
+# were checked at each character by the old lexer, so '{{%' is still '{{' then '%'
+TAGS_RE = re.compile('(' + '|'.join(re.escape(tag) for tag in (EVAL_OPEN, EVAL_CLOSE, EXEC_OPEN, EXEC_CLOSE)) + ')')
+
+# Template source -> its parsed ast, so a template is only lexed and parsed once (see compiled())
+_compiled: dict[str, list[dict]] = {}
 
 class ExecDict(dict):
     def __init__(self, dict):
@@ -36,89 +36,96 @@ class ExecDict(dict):
 
 GLOBALS = {'datetime': datetime}
 
+def compiled() -> dict[str, list[dict]]:
+    '''The ast of every template parsed so far, by source. It's only made of plain values and code
+    objects, so it can be marshaled, and given back to load_compiled() by the next run.'''
+    return _compiled
+
+def load_compiled(asts: dict[str, list[dict]]):
+    '''Reuse the asts of templates parsed by an earlier run, see compiled()'''
+    _compiled.update(asts)
+
+def strip_text(value: str) -> str:
+    '''Remove newlines and unescaped spaces from a text node, "\\ " is a literal space'''
+    value = re.sub(r'\n|\r|((?<!\\) )', '', value, flags=re.MULTILINE)
+    return re.sub(r'\\ ', ' ', value, flags=re.MULTILINE)
+
 class Template:
+    '''A template compiled once, that can then be rendered any number of times (also from multiple threads)'''
     def __init__(self, template: str):
-        tokens = self.lex(template)
-        self.ast = self.parse(tokens)
+        ast = _compiled.get(template)
+        if ast is None:
+            ast = _compiled[template] = self.parse(self.lex(template))
+        self.ast = ast
+        self._ops = self.compile(self.ast)
+
+    def compile(self, ast) -> tuple[tuple[str, object], ...]:
+        '''Turn the ast into a flat tuple of (type, value) ops, merging adjacent text'''
+        ops = []
+        for node in ast:
+            if node['type'] == 'text' and ops and ops[-1][0] == 'text':
+                ops[-1] = ('text', ops[-1][1] + node['value'])
+            elif node['type'] in ('text', 'eval', 'exec'):
+                ops.append((node['type'], node['value']))
+            else:
+                raise Exception('Unknown node type.')
+        return tuple(ops)
 
-    def _process(self, context: dict):
-        new_ast = []
-        if context is None:
-            context = {}
+    def _render(self, context: dict, parts: list[str]):
         local_context = {}
-        for node in self.ast:
-            if node['type'] == 'eval':
+        for type, value in self._ops:
+            if type == 'text':
+                parts.append(value)
+            elif type == 'eval':
                 try:
-                    # print('qqq', context['exif'])
-                    result = eval(node['value'], GLOBALS, UnionDict(context, local_context))
-                    if isinstance(result, Template):
-                        result._process(UnionDict(context, local_context))
-                        new_ast.extend(result.ast)
-                        continue
-                    else:
-                        new_ast.append({
-                            'type': 'text',
-                            'value': result,
-                        })
-                        continue
+                    result = eval(value, GLOBALS, UnionDict(context, local_context))
                 except Exception as e:
                     traceback.print_exc()
                     continue
-            elif node['type'] == 'exec':
-                # print('qqq', context['ffprobe'])
+                if isinstance(result, Template):
+                    # Nested templates (e.g. from var) render straight into our output
+                    result._render(UnionDict(context, local_context), parts)
+                else:
+                    parts.append(result)
+            elif type == 'exec':
                 try:
-
                     c = ExecDict(UnionDict(context, local_context))
-                    exec(node['value'], GLOBALS, c)
-                    # print(c.result)
+                    exec(value, GLOBALS, c)
                     local_context = c.result
                 except Exception as e:
                     traceback.print_exc()
                     continue
-            elif node['type'] == 'text':
-                val = node['value']
-                val = re.sub(r'\n|\r|((?<!\\) )', '', val, flags=re.MULTILINE)
-                val = re.sub(r'\\ ', ' ', val, flags=re.MULTILINE)
-                new_ast.append({
-                    'type': 'text',
-                    'value': val,
-                })
 
-        self.ast = new_ast
+    def subscripts(self, name: str) -> set[tuple]:
+        '''Find how a context variable is used, as the chains of constant subscripts on it.
+
+        E.g. "ffprobe['format']['tags']['creation_time'][:19]" gives ('format', 'tags', 'creation_time').
+        An empty tuple means the variable is used in some other way, as a whole.
+        '''
+        chains = set()
+        for node in self.ast:
+            if node['type'] not in ('eval', 'exec'):
+                continue
+            tree = pyast.parse(node['source'], mode=node['type'])
+            parents = {child: parent for parent in pyast.walk(tree) for child in pyast.iter_child_nodes(parent)}
+            for n in pyast.walk(tree):
+                if not (isinstance(n, pyast.Name) and n.id == name):
+                    continue
+                chain = []
+                while isinstance(parents.get(n), pyast.Subscript) and parents[n].value is n and isinstance(parents[n].slice, pyast.Constant):
+                    n = parents[n]
+                    chain.append(n.slice.value)
+                chains.add(tuple(chain))
+        return chains
 
     def render(self, context: dict = None):
-        self._process({} if context is None else context)
-        with io.StringIO() as memfd:
-            for node in self.ast:
-                if node['type'] == 'text':
-                    memfd.write(node['value'])
-                else:
-                    raise Exception('Not fully processed or unknown node type.')
-            return memfd.getvalue()
+        parts = []
+        self._render({} if context is None else context, parts)
+        return ''.join(parts)
 
     def lex(self, source):
-        source = Source(source)
-        tokens = []
-        current = ''
-        cursor = 0
-        while cursor < len(source):
-            for tag in [EVAL_OPEN, EVAL_CLOSE, EXEC_OPEN, EXEC_CLOSE]:
-                if source[cursor:cursor+len(tag)] == tag:
-                    if current:
-                        tokens.append(current)
-                        current = ''
-
-                    tokens.append(tag)
-                    cursor += len(tag)
-                    break
-            else:
-                current += source[cursor]
-                cursor += 1
-
-        if current:
-            tokens.append(current)
-
-        return tokens
+        # The text between two tags (or at either end) is empty when there's none
+        return [token for token in TAGS_RE.split(source) if token]
     
 
     def parse(self,tokens):
@@ -134,6 +141,7 @@ class Template:
                 ast.append({
                     'type': 'eval',
                     'value': node_ast,
+                    'source': tokens[cursor+1].strip(),
                 })
                 cursor += 3
                 continue
@@ -149,6 +157,7 @@ class Template:
                 ast.append({
                     'type': 'exec',
                     'value': node_ast,
+                    'source': tokens[cursor+1].strip(),
                 })
                 cursor += 3
                 continue
@@ -158,7 +167,7 @@ class Template:
             
             ast.append({
                 'type': 'text',
-                'value': value,
+                'value': strip_text(value),
             })
             cursor += 1
 
@@ -0,0 +1,239 @@
+from abc import ABC, abstractmethod
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+from pathlib import Path
+import select
+import struct
+import time
+import typing as t
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF
+EVENT = struct.Struct('iIII')
+
+# Changes whenever something is mounted or unmounted (it polls as POLLPRI)
+MOUNTINFO = '/proc/self/mountinfo'
+
+logger = logging.getLogger('ingest')
+
+
+def closest_existing(path: Path) -> Path:
+    """path, or its closest parent that exists"""
+    for p in (path, *path.parents):
+        if p.exists():
+            return p
+    return Path('/')
+
+
+def _related(path: Path, root: Path) -> bool:
+    """Whether a change at path can mean new files under root"""
+    return path == root or root in path.parents or path in root.parents
+
+
+class Watcher(ABC):
+    """Watches the roots of the ingest sources, and tells which of them may have new files"""
+
+    def __init__(self, roots: t.Iterable[Path]):
+        self.roots = list(roots)
+
+    @abstractmethod
+    def wait(self, timeout: t.Optional[float]) -> set[Path]:
+        """Wait up to timeout seconds (None for no limit) for changes, returns the roots that changed"""
+
+    def close(self):
+        pass
+
+    def __enter__(self) -> 'Watcher':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PollWatcher(Watcher):
+    """Compares the directories under each root every interval seconds.
+
+    A new file changes the mtime of its directory, and a mounted card changes the device of its
+    mount point, so only directories have to be stat'ed.
+    """
+
+    def __init__(self, roots: t.Iterable[Path], interval: float):
+        super().__init__(roots)
+        self.interval = interval
+        self._signatures = {root: self._signature(root) for root in self.roots}
+        self._next = time.monotonic() + interval
+
+    def _signature(self, root: Path) -> frozenset:
+        if not root.is_dir():
+            st = closest_existing(root).stat()
+            return frozenset([(None, st.st_dev, st.st_mtime_ns)])
+        dirs = []
+        for dirpath, _, _ in os.walk(root):
+            try:
+                st = os.stat(dirpath)
+            except FileNotFoundError:
+                continue
+            dirs.append((dirpath, st.st_dev, st.st_mtime_ns))
+        return frozenset(dirs)
+
+    def wait(self, timeout: t.Optional[float]) -> set[Path]:
+        now = time.monotonic()
+        if timeout is not None and now + timeout < self._next:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(0.0, self._next - now))
+        self._next = time.monotonic() + self.interval
+
+        changed = set()
+        for root in self.roots:
+            signature = self._signature(root)
+            if signature != self._signatures[root]:
+                self._signatures[root] = signature
+                changed.add(root)
+        return changed
+
+
+class InotifyWatcher(Watcher):
+    """Watches every directory under each root with inotify, and the mount table for cards being mounted.
+
+    A root that doesn't exist yet is watched through its closest existing parent, until it appears.
+    """
+
+    def __init__(self, roots: t.Iterable[Path]):
+        super().__init__(roots)
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._libc = libc
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self._watches: dict[int, Path] = {}
+        self._warned_limit = False
+
+        self._poller = select.poll()
+        self._poller.register(self._fd, select.POLLIN)
+        self._mountinfo = None
+        try:
+            self._mountinfo = open(MOUNTINFO, 'rb', buffering=0)
+            self._mounts = self._mountinfo.read()
+            self._poller.register(self._mountinfo.fileno(), select.POLLPRI | select.POLLERR)
+        except OSError:
+            logger.warning(f'Can\'t watch {MOUNTINFO}, cards mounted on an existing directory will only be noticed once files change')
+        self._devices = {root: self._device(root) for root in self.roots}
+        self._rewatch()
+
+    def _device(self, root: Path) -> t.Optional[int]:
+        try:
+            return root.stat().st_dev
+        except OSError:
+            return None
+
+    def _add(self, path: Path):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+        if wd >= 0:
+            self._watches[wd] = path
+            return
+        e = ctypes.get_errno()
+        if e == errno.ENOSPC and not self._warned_limit:
+            self._warned_limit = True
+            logger.warning(f'Out of inotify watches at {path}, raise fs.inotify.max_user_watches to watch all of it')
+        elif e not in (errno.ENOENT, errno.ENOTDIR, errno.ENOSPC):
+            logger.warning(f'Can\'t watch {path}: {os.strerror(e)}')
+
+    def _watch_tree(self, path: Path):
+        for dirpath, _, _ in os.walk(path):
+            self._add(Path(dirpath))
+
+    def _rewatch(self):
+        # Adding a watch for a path that is already watched just updates it
+        for root in self.roots:
+            if root.is_dir():
+                self._watch_tree(root)
+            else:
+                self._add(closest_existing(root))
+
+    def _read_events(self) -> t.Iterator[tuple[int, Path]]:
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0')
+            offset += EVENT.size + length
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            if mask & IN_Q_OVERFLOW:
+                yield mask, None
+                continue
+            if wd not in self._watches:
+                continue
+            path = self._watches[wd]
+            yield mask, path / os.fsdecode(name) if name else path
+
+    def wait(self, timeout: t.Optional[float]) -> set[Path]:
+        ready = self._poller.poll(None if timeout is None else max(0, int(timeout * 1000)))
+        changed = set()
+        for fd, _ in ready:
+            if fd == self._fd:
+                for mask, path in self._read_events():
+                    if path is None:
+                        # Events were lost, anything may have changed
+                        self._rewatch()
+                        changed.update(self.roots)
+                        continue
+                    related = {root for root in self.roots if _related(path, root)}
+                    if related and (mask & (IN_DELETE_SELF | IN_MOVE_SELF) or mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO)):
+                        if any(path == root or path in root.parents for root in related):
+                            # A root, or one of its parents, appeared or went away
+                            self._rewatch()
+                        elif mask & IN_ISDIR:
+                            # A new directory under a root, files may already be in it
+                            self._watch_tree(path)
+                    changed |= related
+            elif self._mountinfo is not None and fd == self._mountinfo.fileno():
+                self._mountinfo.seek(0)
+                mounts = self._mountinfo.read()
+                if mounts != self._mounts:
+                    self._mounts = mounts
+                    # Watches on a mount point now see the directory under the mount, watch the mounted one
+                    self._rewatch()
+                    for root in self.roots:
+                        device = self._device(root)
+                        if device != self._devices[root]:
+                            self._devices[root] = device
+                            changed.add(root)
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+        if self._mountinfo is not None:
+            self._mountinfo.close()
+
+
+def watcher(roots: t.Iterable[Path], poll_interval: float, poll: bool = False) -> Watcher:
+    """An InotifyWatcher, or a PollWatcher if inotify can't be used (or poll is set)"""
+    if not poll:
+        try:
+            return InotifyWatcher(roots)
+        except OSError as e:
+            logger.warning(f'Can\'t use inotify ({e}), polling the ingest sources every {poll_interval}s instead')
+    return PollWatcher(roots, poll_interval)